@@ -0,0 +1,592 @@
+"""A simulated OMERO server, to measure the number of round trips,
+the bytes transfered and the wall time of the `omero_utils` functions
+without a live server.
+
+Every remote call sleeps for `latency` seconds plus the time needed to
+transfer its payload at `bandwidth` bytes per second, and is counted.
+Sleeping releases the GIL, so calls issued from several threads overlap
+as they would against a real server.
+
+The OMERO model objects (ROIs, shapes, rtypes) are the real `omero-py`
+ones, only the server side is faked.
+
+Usage
+-----
+.. code-block:: python
+    server = FakeServer(latency=0.01, bandwidth=50e6)
+    image_id = server.add_image(size_x=1024, size_y=1024, size_z=8)
+    conn = FakeGateway(server)
+    with OmeroImageReader(image_id, conn) as reader:
+        stack = reader.as_array()[...]
+    print(server.report())
+
+"""
+import io
+import time
+import itertools
+import threading
+from datetime import datetime
+from collections import Counter
+
+import numpy as np
+from scipy import ndimage
+from PIL import Image
+
+import omero
+from omero.rtypes import rdouble, rint, rlong, rstring, rtime, unwrap
+
+from omero_utils.stats import roi_nbytes
+
+# numpy dtype names to OMERO pixels types, where they differ
+PIXEL_TYPES = {"float32": "float", "float64": "double"}
+
+
+class FakeServer:
+    """State of the simulated server: images, ROIs, and the calls counters
+
+    Attributes
+    ----------
+    host : str, the server name, different for each instance as the
+        image ids of the instances overlap
+    latency : float, the duration of a round trip, in seconds
+    bandwidth : float, the transfer rate, in bytes per second
+    calls : `collections.Counter`, number of calls per remote method
+    nbytes : int, number of bytes transfered, both ways
+
+    """
+
+    _instances = itertools.count()
+
+    def __init__(self, latency=0.005, bandwidth=100e6, seed=0):
+        self.host = f"fake{next(self._instances)}.omero"
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.images = {}
+        self.rois = {}
+        self.calls = Counter()
+        self.nbytes = 0
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._rng = np.random.default_rng(seed)
+        self._thumbnails = {}
+
+    def new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def call(self, method, nbytes=0):
+        """Records a round trip to `method` transfering `nbytes`,
+        and waits for as long as it would take
+        """
+        with self._lock:
+            self.calls[method] += 1
+            self.nbytes += nbytes
+        time.sleep(self.latency + nbytes / self.bandwidth)
+
+    def reset(self):
+        """Resets the calls counters"""
+        with self._lock:
+            self.calls.clear()
+            self.nbytes = 0
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def report(self):
+        """Returns a dictionnary with the counters"""
+        with self._lock:
+            return {
+                "round_trips": sum(self.calls.values()),
+                "nbytes": self.nbytes,
+                "calls": dict(self.calls),
+            }
+
+    def add_image(
+        self,
+        size_x=512,
+        size_y=512,
+        size_z=1,
+        size_c=1,
+        size_t=1,
+        dtype="uint16",
+        n_levels=1,
+    ):
+        """Adds an image filled with random blobs and returns its id.
+        If `n_levels` > 1, the image is pyramidal, each level being
+        twice smaller than the previous one.
+        """
+        image_id = self.new_id()
+        shape = (size_t, size_c, size_z, size_y, size_x)
+        info = np.iinfo(dtype) if np.dtype(dtype).kind in "ui" else None
+        top = min(info.max, 4095) if info else 1.0
+        blobs = np.zeros((size_y, size_x))
+        n_blobs = max(size_x * size_y // 4096, 1)
+        rows = self._rng.integers(0, size_y, n_blobs)
+        cols = self._rng.integers(0, size_x, n_blobs)
+        blobs[rows, cols] = top * 100
+        blobs = ndimage.gaussian_filter(blobs, 5)
+        data = self._rng.normal(top / 8, top / 32, size=shape) + blobs
+        if info:
+            data = data.clip(info.min, info.max)
+        data = data.astype(dtype)
+        pyramid = [data]
+        for _ in range(n_levels - 1):
+            level = pyramid[-1]
+            h, w = level.shape[-2] // 2 * 2, level.shape[-1] // 2 * 2
+            blocks = level[..., :h, :w].reshape(
+                level.shape[:3] + (h // 2, 2, w // 2, 2)
+            )
+            pyramid.append(blocks.mean(axis=(-3, -1)).astype(dtype))
+        self.images[image_id] = {
+            "data": data,
+            "pyramid": pyramid,
+            "pixels_id": self.new_id(),
+            "name": f"image_{image_id}",
+            "date": datetime(2020, 1, 1),
+        }
+        self.rois[image_id] = []
+        return image_id
+
+    def add_rois(self, image_id, n_rois, radius=8, n_points=16, z=None, t=None):
+        """Adds `n_rois` random polygonal ROIs to an image, and returns them"""
+        data = self.images[image_id]["data"]
+        size_y, size_x = data.shape[-2:]
+        angles = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+        rois = []
+        for _ in range(n_rois):
+            xc = self._rng.uniform(radius, size_x - radius)
+            yc = self._rng.uniform(radius, size_y - radius)
+            r = radius * self._rng.uniform(0.6, 1.0, n_points)
+            points = np.column_stack((xc + r * np.cos(angles), yc + r * np.sin(angles)))
+            shape = omero.model.PolygonI(self.new_id(), True)
+            shape.version = rint(0)
+            shape.points = rstring(" ".join(f"{x:.1f},{y:.1f}" for x, y in points))
+            if z is not None:
+                shape.theZ = rint(z)
+            if t is not None:
+                shape.theT = rint(t)
+            roi = omero.model.RoiI(self.new_id(), True)
+            roi.setImage(omero.model.ImageI(image_id, False))
+            roi.addShape(shape)
+            rois.append(roi)
+        self.rois[image_id].extend(rois)
+        return rois
+
+    def thumbnail(self, image_id, size):
+        """Returns the JPEG encoded thumbnail of an image"""
+        key = (image_id, size)
+        if key not in self._thumbnails:
+            plane = self.images[image_id]["data"][0, 0, 0].astype(np.float32)
+            plane = 255 * (plane - plane.min()) / max(np.ptp(plane), 1)
+            image = Image.fromarray(plane.astype(np.uint8))
+            image.thumbnail((size, size))
+            with io.BytesIO() as out:
+                image.save(out, format="JPEG")
+                self._thumbnails[key] = out.getvalue()
+        return self._thumbnails[key]
+
+
+class FakeGateway:
+    """Stands for a `BlitzGateway` connected to a `FakeServer`"""
+
+    def __init__(self, server, host=None, port=4064):
+        self.server = server
+        self.host = server.host if host is None else host
+        self.port = port
+        self.SERVICE_OPTS = _Context()
+        self._connected = False
+
+        # stands for the omero.client, only the raw pixels store is simulated
+        self.c = _Client(server)
+
+    def connect(self, sUuid=None):
+        self.server.call("connect")
+        self._connected = True
+        return True
+
+    def isConnected(self):
+        return self._connected
+
+    def keepAlive(self):
+        self.server.call("keepAlive")
+        return self._connected
+
+    def close(self, hard=True):
+        self._connected = False
+
+    def getObject(self, obj_type, oid=None):
+        if obj_type != "Image":
+            raise NotImplementedError(f"Only images are simulated, not {obj_type}")
+        self.server.call("getObject", 512)
+        if oid not in self.server.images:
+            return None
+        return FakeImage(self.server, oid)
+
+    def getRoiService(self):
+        return FakeRoiService(self.server)
+
+    def getUpdateService(self):
+        return FakeUpdateService(self.server)
+
+    def getQueryService(self):
+        return FakeQueryService(self.server)
+
+    def createThumbnailStore(self):
+        self.server.call("createThumbnailStore")
+        return FakeThumbnailStore(self.server)
+
+
+class _Client:
+    def __init__(self, server):
+        self.sf = _ServiceFactory(server)
+
+
+class _ServiceFactory:
+    def __init__(self, server):
+        self.server = server
+
+    def createRawPixelsStore(self, ctx=None):
+        self.server.call("createRawPixelsStore")
+        return FakeRawPixelsStore(self.server)
+
+
+class _Context(dict):
+    """Stands for the `omero.gateway.ServiceOptsDict` of the gateway"""
+
+    def setOmeroGroup(self, group):
+        self["omero.group"] = str(group)
+
+
+class _Value:
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakeImage:
+    """Stands for an `omero.gateway.ImageWrapper`, its attributes
+    are loaded with the image
+    """
+
+    def __init__(self, server, image_id):
+        self.server = server
+        self.id = image_id
+        self._record = server.images[image_id]
+        self._obj = omero.model.ImageI(image_id, False)
+        self.sizeT, self.sizeC, self.sizeZ, self.sizeY, self.sizeX = self._record[
+            "data"
+        ].shape
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self._record["name"]
+
+    def getSizeX(self):
+        return self.sizeX
+
+    def getSizeY(self):
+        return self.sizeY
+
+    def getSizeZ(self):
+        return self.sizeZ
+
+    def getSizeC(self):
+        return self.sizeC
+
+    def getSizeT(self):
+        return self.sizeT
+
+    def getAcquisitionDate(self):
+        return self._record["date"]
+
+    def getObjectiveSettings(self):
+        return None
+
+    def getChannelLabels(self):
+        self.server.call("getChannelLabels", 64 * self.sizeC)
+        return [str(c) for c in range(self.sizeC)]
+
+    def getPixelRange(self):
+        data = self._record["data"]
+        if data.dtype.kind in "ui":
+            info = np.iinfo(data.dtype)
+            return info.min, info.max
+        return 0.0, 1.0
+
+    def getPrimaryPixels(self):
+        return FakePixels(self.server, self)
+
+
+class FakePixels:
+    """Stands for an `omero.gateway.PixelsWrapper`, each plane or tile
+    read is a round trip, as with the raw pixels store. As in omero-py,
+    `getPlanes` and `getTiles` create, set and close a raw pixels store
+    on each call, and `getPlane` goes through `getPlanes`.
+    """
+
+    def __init__(self, server, image):
+        self.server = server
+        self.image = image
+        self.id = image._record["pixels_id"]
+        self._data = image._record["data"]
+        self.sizeX, self.sizeY = image.sizeX, image.sizeY
+        self.sizeZ, self.sizeC, self.sizeT = image.sizeZ, image.sizeC, image.sizeT
+
+    def getId(self):
+        return self.id
+
+    def getSizeX(self):
+        return self.sizeX
+
+    def getSizeY(self):
+        return self.sizeY
+
+    def getSizeZ(self):
+        return self.sizeZ
+
+    def getSizeC(self):
+        return self.sizeC
+
+    def getSizeT(self):
+        return self.sizeT
+
+    def getPixelsType(self):
+        return _Value(PIXEL_TYPES.get(self._data.dtype.name, self._data.dtype.name))
+
+    def getPhysicalSizeX(self):
+        return _Value(0.5)
+
+    def _read(self, z, c, t, tile=None):
+        if tile is None:
+            plane = self._data[t, c, z]
+        else:
+            x, y, w, h = tile
+            plane = self._data[t, c, z, y : y + h, x : x + w]
+        self.server.call("getTile" if tile is not None else "getPlane", plane.nbytes)
+        return plane.copy()
+
+    def _open_store(self):
+        self.server.call("createRawPixelsStore")
+        self.server.call("setPixelsId")
+
+    def getPlane(self, theZ=0, theC=0, theT=0):
+        planes = self.getPlanes([(theZ, theC, theT)])
+        try:
+            return next(planes)
+        finally:
+            planes.close()
+
+    def getPlanes(self, zctList):
+        self._open_store()
+        try:
+            for z, c, t in zctList:
+                yield self._read(z, c, t)
+        finally:
+            self.server.call("close")
+
+    def getTile(self, theZ=0, theC=0, theT=0, tile=None):
+        tiles = self.getTiles([(theZ, theC, theT, tile)])
+        try:
+            return next(tiles)
+        finally:
+            tiles.close()
+
+    def getTiles(self, zctTileList):
+        self._open_store()
+        try:
+            for z, c, t, tile in zctTileList:
+                yield self._read(z, c, t, tile)
+        finally:
+            self.server.call("close")
+
+
+class _RoiResult:
+    def __init__(self, rois):
+        self.rois = rois
+
+
+class FakeRoiService:
+    def __init__(self, server):
+        self.server = server
+
+    def findByImage(self, image_id, options, ctx=None):
+        rois = list(self.server.rois.get(unwrap(image_id), []))
+        self.server.call("findByImage", sum(roi_nbytes(roi) for roi in rois))
+        return _RoiResult(rois)
+
+
+class FakeUpdateService:
+    def __init__(self, server):
+        self.server = server
+
+    def _save(self, roi):
+        roi.setId(rlong(self.server.new_id()))
+        roi.version = rint(0)
+        for u in range(roi.sizeOfShapes()):
+            shape = roi.getShape(u)
+            shape.setId(rlong(self.server.new_id()))
+            shape.version = rint(0)
+        image_id = unwrap(roi.getImage().getId())
+        self.server.rois.setdefault(image_id, []).append(roi)
+        return roi
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self.server.call("saveAndReturnObject", 2 * roi_nbytes(obj))
+        return self._save(obj)
+
+    def saveAndReturnIds(self, objs, ctx=None):
+        self.server.call(
+            "saveAndReturnIds", sum(roi_nbytes(obj) for obj in objs) + 8 * len(objs)
+        )
+        return [unwrap(self._save(obj).getId()) for obj in objs]
+
+
+class FakeQueryService:
+    """Answers the projection queries issued by `omero_utils.images`"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def projection(self, query, params, ctx=None):
+        values = {key: unwrap(value) for key, value in params.map.items()}
+        images = self.server.images
+        if "from Image i join i.pixels" in query:
+            rows = self._image_metadata(values["ids"])
+        elif "from Image i" in query:
+            selected = query[len("select ") : query.index(" from")].split(", ")
+            ids = sorted(i for i in images if i > values.get("last", -1))
+            if params.theFilter is not None and params.theFilter.limit is not None:
+                ids = ids[: unwrap(params.theFilter.limit)]
+            rows = [
+                [rlong(i)] + [self._image_column(i, expr) for expr in selected[1:]]
+                for i in ids
+            ]
+        elif "from Pixels p join p.channels" in query:
+            rows = [
+                [rlong(i), rint(c), rstring(str(c)), None]
+                for i in values["ids"]
+                if i in images
+                for c in range(images[i]["data"].shape[1])
+            ]
+        elif "from Pixels p" in query:
+            rows = [
+                [rlong(i), rlong(images[i]["pixels_id"])]
+                for i in values["ids"]
+                if i in images
+            ]
+        else:
+            raise NotImplementedError(f"Query not simulated: {query}")
+        self.server.call("projection", 32 * sum(len(row) for row in rows))
+        return rows
+
+    def _image_column(self, image_id, expr):
+        record = self.server.images[image_id]
+        if expr == "i.name":
+            return rstring(record["name"])
+        if expr == "i.acquisitionDate":
+            return rtime(int(record["date"].timestamp() * 1000))
+        return None
+
+    def _image_metadata(self, image_ids):
+        rows = []
+        for i in image_ids:
+            if i not in self.server.images:
+                continue
+            size_t, size_c, size_z, size_y, size_x = self.server.images[i]["data"].shape
+            date = int(self.server.images[i]["date"].timestamp() * 1000)
+            rows.append(
+                [rlong(i), rtime(date)]
+                + [rint(v) for v in (size_x, size_y, size_z, size_c, size_t)]
+                + [rdouble(0.5), None, None]
+            )
+        return rows
+
+
+class FakeThumbnailStore:
+    def __init__(self, server):
+        self.server = server
+
+    def getThumbnailByLongestSideSet(self, size, pixels_ids, ctx=None):
+        size = unwrap(size)
+        by_pixels = {
+            record["pixels_id"]: image_id
+            for image_id, record in self.server.images.items()
+        }
+        thumbs = {
+            pid: self.server.thumbnail(by_pixels[pid], size)
+            for pid in pixels_ids
+            if pid in by_pixels
+        }
+        self.server.call(
+            "getThumbnailByLongestSideSet", sum(len(th) for th in thumbs.values())
+        )
+        return thumbs
+
+    def close(self):
+        pass
+
+
+class _ResolutionDescription:
+    def __init__(self, size_x, size_y):
+        self.sizeX = size_x
+        self.sizeY = size_y
+
+
+class FakeRawPixelsStore:
+    """Stands for an `omero.api.RawPixelsStore`, with resolution levels
+    numbered from the coarsest one, and big endian tiles
+    """
+
+    tile_size = (256, 256)
+
+    def __init__(self, server):
+        self.server = server
+        self._pyramid = None
+        self._level = 0
+
+    def setPixelsId(self, pixels_id, bypass_original_file, ctx=None):
+        self.server.call("setPixelsId")
+        for record in self.server.images.values():
+            if record["pixels_id"] == pixels_id:
+                self._pyramid = record["pyramid"]
+        # the full resolution level
+        self._level = len(self._pyramid) - 1
+
+    def getResolutionLevels(self):
+        self.server.call("getResolutionLevels")
+        return len(self._pyramid)
+
+    def getResolutionDescriptions(self):
+        self.server.call("getResolutionDescriptions")
+        return [
+            _ResolutionDescription(level.shape[-1], level.shape[-2])
+            for level in self._pyramid
+        ]
+
+    def setResolutionLevel(self, level):
+        self.server.call("setResolutionLevel")
+        self._level = level
+
+    def getTileSize(self):
+        self.server.call("getTileSize")
+        return list(self.tile_size)
+
+    def getTile(self, z, c, t, x, y, w, h):
+        data = self._pyramid[len(self._pyramid) - 1 - self._level]
+        tile = data[t, c, z, y : y + h, x : x + w]
+        self.server.call("getTile", tile.nbytes)
+        return tile.astype(tile.dtype.newbyteorder(">")).tobytes()
+
+    def getPlane(self, z, c, t):
+        plane = self._pyramid[len(self._pyramid) - 1 - self._level][t, c, z]
+        self.server.call("getPlane", plane.nbytes)
+        return plane.astype(plane.dtype.newbyteorder(">")).tobytes()
+
+    def close(self):
+        self.server.call("close")
@@ -0,0 +1,401 @@
+"""Runs the `omero_utils` benchmarks against a simulated OMERO server,
+and reports the wall time, round trips and bytes transfered by each
+variant of each benchmark.
+
+Usage
+-----
+.. code-block:: sh
+    python benchmarks/run_benchmarks.py --latency 10 --bandwidth 50
+    python benchmarks/run_benchmarks.py --only reader roi_thumbs --json results.json
+
+"""
+import io
+import sys
+import json
+import time
+import argparse
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from fake_omero import FakeServer, FakeGateway
+
+from omero_utils.pool import SessionPool
+from omero_utils.imageio import OmeroImageReader, read_many, clear_histograms_cache
+from omero_utils.images import get_images_metadata, get_thumbnails
+from omero_utils.roi_utils import (
+    get_rois_as_labels,
+    get_roi_thumb,
+    get_roi_thumbs,
+    html_thumb,
+    register_shape_to_roi,
+    register_polygons,
+    get_shape_points,
+    clear_geometry_cache,
+)
+from omero_utils.widgets import ImageScatterViz, ROIScatterViz
+
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Registers a benchmark, a function of the server, a connection
+    and a pool yielding (variant name, callable) pairs
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def connect(server):
+    conn = FakeGateway(server)
+    conn.connect()
+    return conn
+
+
+@benchmark
+def reader(server, conn, pool):
+    image_id = server.add_image(size_x=512, size_y=512, size_z=16, size_c=2)
+
+    def plane_by_plane():
+        with OmeroImageReader(image_id, conn, batch_size=1, prefetch=0) as reader:
+            for c in range(2):
+                for z in range(16):
+                    reader.get_plane(c, z, 0)
+
+    def iter_planes():
+        with OmeroImageReader(image_id, conn) as reader:
+            for _ in reader:
+                pass
+
+    def as_array():
+        with OmeroImageReader(image_id, conn) as reader:
+            reader.as_array()[...]
+
+    def crop():
+        with OmeroImageReader(image_id, conn) as reader:
+            reader.as_array()[0, :, :, 100:228, 100:228]
+
+    def stack_max():
+        with OmeroImageReader(image_id, conn) as reader:
+            np.stack([reader.get_plane(0, z, 0) for z in range(16)]).max(axis=0)
+
+    def project_max():
+        with OmeroImageReader(image_id, conn) as reader:
+            reader.project("z", "max", c=0)
+
+    def stack_percentiles():
+        with OmeroImageReader(image_id, conn) as reader:
+            np.percentile(reader.as_array()[0, 0], [1, 99.8])
+
+    def histogram_percentiles():
+        clear_histograms_cache()
+        with OmeroImageReader(image_id, conn) as reader:
+            reader.histogram(c=0).percentile([1, 99.8])
+
+    yield "get_plane one by one", plane_by_plane
+    yield "iter_planes", iter_planes
+    yield "as_array()[...]", as_array
+    yield "as_array() crop", crop
+    yield "stacked planes max", stack_max
+    yield "project max", project_max
+    yield "stacked planes percentiles", stack_percentiles
+    yield "histogram percentiles", histogram_percentiles
+
+
+@benchmark
+def many_images(server, conn, pool):
+    image_ids = [
+        server.add_image(size_x=256, size_y=256, size_z=4, size_c=2) for _ in range(8)
+    ]
+
+    def sequential():
+        for image_id in image_ids:
+            with OmeroImageReader(image_id, conn) as reader:
+                reader.as_array()[...]
+
+    def concurrent():
+        for _ in read_many(image_ids, pool, workers=4):
+            pass
+
+    def metadata():
+        get_images_metadata(image_ids, conn)
+
+    yield "sequential readers", sequential
+    yield "read_many", concurrent
+    yield "get_images_metadata", metadata
+
+
+@benchmark
+def labels(server, conn, pool):
+    image_id = server.add_image(size_x=1024, size_y=1024)
+    server.add_rois(image_id, 2000, radius=10)
+    image = conn.getObject("Image", image_id)
+
+    def rasterize():
+        clear_geometry_cache()
+        get_rois_as_labels(image, conn)
+
+    yield "get_rois_as_labels", rasterize
+
+
+@benchmark
+def roi_thumbs(server, conn, pool):
+    image_id = server.add_image(size_x=2048, size_y=2048, size_c=3)
+    rois = server.add_rois(image_id, 200, radius=20)
+    image = conn.getObject("Image", image_id)
+    thumbs = {}
+
+    def one_by_one():
+        clear_geometry_cache()
+        for roi in rois:
+            get_roi_thumb(conn, image, roi)
+
+    def batched():
+        clear_geometry_cache()
+        thumbs.update(get_roi_thumbs(conn, image, rois))
+
+    def render():
+        for thumb in thumbs.values():
+            html_thumb(thumb)
+
+    def render_webp():
+        for thumb in thumbs.values():
+            html_thumb(thumb, fmt="webp")
+
+    yield "get_roi_thumb one by one", one_by_one
+    yield "get_roi_thumbs", batched
+    yield "html_thumb jpeg", render
+    yield "html_thumb webp", render_webp
+
+
+@benchmark
+def pyramid(server, conn, pool):
+    image_id = server.add_image(size_x=4096, size_y=4096, size_c=2, n_levels=5)
+    rois = server.add_rois(image_id, 100, radius=300)
+    image = conn.getObject("Image", image_id)
+
+    def full_resolution():
+        clear_geometry_cache()
+        get_roi_thumbs(conn, image, rois)
+
+    def display_size():
+        clear_geometry_cache()
+        get_roi_thumbs(conn, image, rois, size=200)
+
+    def full_plane():
+        with OmeroImageReader(image_id, conn) as reader:
+            reader.get_plane(0, 0, 0)
+
+    def preview():
+        with OmeroImageReader(image_id, conn) as reader:
+            reader.get_preview(0, 0, 0, size=512)
+
+    yield "get_roi_thumbs", full_resolution
+    yield "get_roi_thumbs size=200", display_size
+    yield "get_plane", full_plane
+    yield "get_preview size=512", preview
+
+
+@benchmark
+def register(server, conn, pool):
+    image_id = server.add_image(size_x=1024, size_y=1024)
+    polygons = [roi_points(roi) for roi in server.add_rois(image_id, 500)]
+    server.rois[image_id] = []
+    image = conn.getObject("Image", image_id)
+
+    def one_by_one():
+        for polygon in polygons:
+            register_shape_to_roi(image, polygon, conn)
+
+    def chunked():
+        register_polygons(image, polygons, conn, chunk_size=100)
+
+    def pooled():
+        register_polygons(image, polygons, pool, chunk_size=100, workers=4)
+
+    yield "register_shape_to_roi one by one", one_by_one
+    yield "register_polygons", chunked
+    yield "register_polygons with a pool", pooled
+
+
+def roi_points(roi):
+    return get_shape_points(roi.getShape(0)).copy()
+
+
+@benchmark
+def image_thumbs(server, conn, pool):
+    image_ids = [server.add_image(size_x=256, size_y=256) for _ in range(64)]
+
+    def one_by_one():
+        store = conn.createThumbnailStore()
+        for image_id in image_ids:
+            get_thumbnails([image_id], conn, store=store)
+
+    def batched():
+        get_thumbnails(image_ids, conn)
+
+    yield "get_thumbnails one by one", one_by_one
+    yield "get_thumbnails batched", batched
+
+
+def setup_widget(viz, conn, pool):
+    """Sets up a scatter widget as if logged in through its form, its pool
+    joining the session of the simulated server
+    """
+    viz.connector.conn = conn
+    viz.setup_graph(None)
+    viz.pool.factory = pool.factory
+    return viz
+
+
+def hover(viz, name):
+    """Hovers over point `name`, and waits for its thumbnail to show"""
+    viz.show_thumb(None, {"data": {"name": name}})
+    wait_loaded(viz)
+
+
+def wait_loaded(viz):
+    """Waits for the thumbnails being loaded in the background"""
+    viz._loader.submit(lambda: None).result()
+
+
+@benchmark
+def image_widget(server, conn, pool):
+    image_ids = [server.add_image(size_x=256, size_y=256) for _ in range(256)]
+    rng = np.random.default_rng(0)
+    measures = pd.DataFrame(rng.random((256, 3)), index=image_ids, columns=list("abc"))
+    viz = setup_widget(ImageScatterViz(measures, mouseover=True), conn, pool)
+
+    def one_by_one():
+        viz.thumbs.clear()
+        for image_id in image_ids:
+            viz.fetch_thumbs([image_id])
+
+    def batched():
+        viz.thumbs.clear()
+        for ids in np.array_split(image_ids, 256 // viz.batch_size):
+            viz.fetch_thumbs(list(ids))
+
+    def hover_all():
+        viz.thumbs.clear()
+        for image_id in image_ids:
+            hover(viz, image_id)
+
+    def select_then_hover():
+        viz.thumbs.clear()
+        viz.scat.selected = None
+        viz.scat.selected = np.arange(len(image_ids))
+        wait_loaded(viz)
+        for image_id in image_ids:
+            hover(viz, image_id)
+
+    try:
+        yield "fetch_thumbs one by one", one_by_one
+        yield "fetch_thumbs batched", batched
+        yield "hover every point", hover_all
+        yield "select all, then hover", select_then_hover
+    finally:
+        viz.close()
+
+
+@benchmark
+def roi_widget(server, conn, pool):
+    image_id = server.add_image(size_x=2048, size_y=2048, size_c=3)
+    rois = server.add_rois(image_id, 200, radius=20)
+    centers = np.array([roi_points(roi).mean(axis=0) for roi in rois])
+    measures = pd.DataFrame(
+        {"X": centers[:, 0], "Y": centers[:, 1], "area": np.arange(len(rois))}
+    )
+    viz = setup_widget(ROIScatterViz(image_id, measures, mouseover=True), conn, pool)
+    # the prefetch started with the widget is measured below
+    viz.stop_prefetch()
+
+    def get_thumb():
+        viz.thumbs.clear()
+        for idx in range(len(rois)):
+            viz.get_thumb(idx)
+
+    def hover_all():
+        viz.thumbs.clear()
+        for idx in range(len(rois)):
+            hover(viz, idx)
+
+    def prefetch_then_hover():
+        viz.thumbs.clear()
+        viz.prefetch_thumbs()
+        viz._prefetcher.join()
+        for idx in range(len(rois)):
+            hover(viz, idx)
+
+    try:
+        yield "get_thumb one by one", get_thumb
+        yield "hover every point", hover_all
+        yield "prefetch_thumbs, then hover", prefetch_then_hover
+    finally:
+        viz.close()
+
+
+def measure(server, func):
+    """Runs `func` and returns its wall time and the server counters"""
+    server.reset()
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        func()
+    wall = time.perf_counter() - start
+    report = server.report()
+    report["wall"] = wall
+    return report
+
+
+def run(names, latency, bandwidth, repeat=1):
+    """Runs the benchmarks in `names` and returns their results as a list
+    of dictionnaries
+    """
+    results = []
+    for name in names:
+        server = FakeServer(latency=latency, bandwidth=bandwidth)
+        conn = connect(server)
+        pool = SessionPool(conn, size=4, keepalive=0, factory=lambda: connect(server))
+        try:
+            for variant, func in BENCHMARKS[name](server, conn, pool):
+                runs = [measure(server, func) for _ in range(repeat)]
+                best = min(runs, key=lambda report: report["wall"])
+                best.update(benchmark=name, variant=variant)
+                results.append(best)
+                mib = best["nbytes"] / 2 ** 20
+                print(
+                    f"{name:<14} {variant:<34} {best['wall']:>9.3f} s "
+                    f"{best['round_trips']:>8d} calls {mib:>10.2f} MiB"
+                )
+        finally:
+            pool.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--latency", type=float, default=5, help="round trip time in ms (default 5)"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=100, help="bandwidth in MB/s (default 100)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per variant, the best is kept"
+    )
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("--json", help="file where to write the results")
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.latency / 1000, args.bandwidth * 1e6, args.repeat)
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""asyncio interface to the image and ROI functions
+
+The OMERO client is blocking, so each call is run in a thread of a bounded
+executor shared by the whole process, while an `AsyncSession` limits the
+number of requests in flight on its session with a semaphore. Many small
+requests issued together with `asyncio.gather` thus overlap, up to this limit.
+
+Pooled connections are reserved in the event loop before a request takes
+an in flight slot, so a request never waits for a connection while holding
+a slot. An open `AsyncOmeroImageReader` keeps its connection reserved until
+it is closed: calls made while readers are open need a free connection
+besides theirs.
+
+Usage
+-----
+.. code-block:: python
+    async def main(conn, image_ids):
+        async with aio.AsyncSession(conn, max_in_flight=16) as session:
+            async with aio.AsyncOmeroImageReader(image_ids[0], session) as reader:
+                async for (c, z, t), plane in reader:
+                    process(plane)
+
+            stacks = await asyncio.gather(
+                *(aio.read_image(session, image_id) for image_id in image_ids)
+            )
+
+            image = await aio.get_image(session, image_ids[0])
+            thumbs = await asyncio.gather(
+                *(aio.get_roi_thumb(session, image, roi) for roi in rois)
+            )
+
+"""
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import product
+
+from . import roi_utils
+from . import images
+from .imageio import OmeroImageReader, chunked
+from .pool import SessionPool
+from .stats import CallStats, STATS, instrument
+
+
+EXECUTOR_WORKERS = 32
+"""Number of threads of the shared executor running the blocking calls"""
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the executor shared by all the sessions, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=EXECUTOR_WORKERS, thread_name_prefix="omero_utils_aio"
+            )
+        return _executor
+
+
+class AsyncSession:
+    """Runs blocking OMERO calls from asyncio code, with pooled
+    connections and at most `max_in_flight` calls at once.
+
+    Attributes
+    ----------
+    pool : `omero_utils.pool.SessionPool`
+        the connections of the session, at most `pool.size` of them
+        are borrowed at once
+    stats : `omero_utils.stats.CallStats`, the calls made through the session
+
+    """
+
+    def __init__(self, conn, max_in_flight=8, executor=None):
+        """
+        Parameters
+        ----------
+        conn : `omero_utils.pool.SessionPool` or a `BlitzGateway` connection
+            if a connection is passed, a pool of `max_in_flight` connections
+            sharing its session is created, and closed with the session
+        max_in_flight : int, default 8
+            maximum number of calls running at once
+        executor : `concurrent.futures.Executor`, optional
+            where the blocking calls run, defaults to the shared executor,
+            see `get_executor`
+
+        """
+        self._own_pool = not isinstance(conn, SessionPool)
+        self.pool = SessionPool(conn, size=max_in_flight) if self._own_pool else conn
+        self.max_in_flight = max_in_flight
+        self.executor = executor
+        self.stats = CallStats("async session", parent=STATS)
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        # connections are reserved before an in flight slot is taken
+        self._connections = asyncio.Semaphore(self.pool.size)
+
+    async def run(self, func, *args, **kwargs):
+        """Runs `func(*args, **kwargs)` in the executor and returns its result"""
+        executor = self.executor or get_executor()
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            return await loop.run_in_executor(
+                executor, partial(func, *args, **kwargs)
+            )
+
+    async def call(self, func, *args, **kwargs):
+        """Runs `func(conn, *args, **kwargs)` in the executor with a pooled
+        connection `conn`, and returns its result
+        """
+        async with self._connections:
+            return await self.run(self._with_conn, func, args, kwargs)
+
+    def _with_conn(self, func, args, kwargs):
+        with self.pool.session() as conn:
+            return func(instrument(conn, self.stats), *args, **kwargs)
+
+    async def close(self):
+        """Closes the pool if it was created by the session"""
+        if self._own_pool:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor or get_executor(), self.pool.close
+            )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncOmeroImageReader:
+    """Async counterpart of `omero_utils.imageio.OmeroImageReader`,
+    holding a pooled connection of `session` while it is open. Opening
+    waits for a connection of the pool to be free.
+
+    Attributes
+    ----------
+    reader : the underlying `OmeroImageReader`, once opened
+
+    """
+
+    def __init__(self, image_id, session, batch_size=16, prefetch=2, **reader_kwargs):
+        """
+        Parameters
+        ----------
+        image_id : int
+        session : `AsyncSession`
+        batch_size : int, default 16
+            number of planes retrieved per call when iterating
+        prefetch : int, default 2
+            number of batches requested ahead when iterating
+        reader_kwargs :
+            passed to the `OmeroImageReader` constructor
+
+        """
+        self.image_id = image_id
+        self.session = session
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self._reader_kwargs = reader_kwargs
+        self.reader = None
+
+    async def open(self):
+        if self.reader is None:
+            # the reader borrows the connection until it is closed
+            await self.session._connections.acquire()
+            try:
+                self.reader = await self.session.run(
+                    OmeroImageReader,
+                    self.image_id,
+                    pool=self.session.pool,
+                    batch_size=self.batch_size,
+                    prefetch=0,
+                    **self._reader_kwargs,
+                )
+            except BaseException:
+                self.session._connections.release()
+                raise
+        return self
+
+    async def close(self):
+        if self.reader is not None:
+            try:
+                await self.session.run(self.reader.__exit__, None, None, None)
+            finally:
+                self.reader = None
+                self.session._connections.release()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def get_metadata(self):
+        """Returns the image metadata, see `OmeroImageReader.get_metadata`"""
+        return await self.session.run(lambda: self.reader.metadata)
+
+    async def get_plane(self, c, z, t):
+        return await self.session.run(self.reader.get_plane, c, z, t)
+
+    async def get_planes(self, czts):
+        """Returns the list of planes for each (c, z, t) tuple in `czts`"""
+        return await self.session.run(lambda: list(self.reader.get_planes(czts)))
+
+    async def get_tiles(self, czt_tiles):
+        """Returns the list of tiles for each (c, z, t, (x, y, width, height))
+        tuple in `czt_tiles`
+        """
+        return await self.session.run(lambda: list(self.reader.get_tiles(czt_tiles)))
+
+    async def read(self, key=Ellipsis):
+        """Returns `reader.as_array()[key]`, see `imageio.LazyImageArray`"""
+        return await self.session.run(lambda: self.reader.as_array()[key])
+
+    async def iter_planes(self, czts=None, batch_size=None, prefetch=None):
+        """Asynchronously iterates over ((c, z, t), plane) pairs,
+        see `OmeroImageReader.iter_planes`. The next `prefetch`
+        chunks are requested while the current one is consumed.
+        """
+        if czts is None:
+            metadata = await self.get_metadata()
+            czts = product(
+                range(metadata["SizeC"]),
+                range(metadata["SizeZ"]),
+                range(metadata["SizeT"]),
+            )
+        batch_size = self.batch_size if batch_size is None else batch_size
+        prefetch = self.prefetch if prefetch is None else prefetch
+
+        chunks = chunked(czts, batch_size)
+        pending = deque()
+        try:
+            while True:
+                while len(pending) <= prefetch:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    planes = asyncio.ensure_future(self.get_planes(chunk))
+                    pending.append((chunk, planes))
+                if not pending:
+                    return
+                chunk, planes = pending.popleft()
+                for czt, plane in zip(chunk, await planes):
+                    yield czt, plane
+        finally:
+            for _, planes in pending:
+                planes.cancel()
+
+    def __aiter__(self):
+        return self.iter_planes()
+
+
+async def read_image(session, image_id, key=Ellipsis, **reader_kwargs):
+    """Reads an image, or the `key` part of its (t, c, z, y, x) array
+
+    Returns
+    -------
+    metadata : dict, see `OmeroImageReader.get_metadata`
+    planes : `np.ndarray`
+    """
+    async with AsyncOmeroImageReader(image_id, session, **reader_kwargs) as reader:
+        return await reader.get_metadata(), await reader.read(key)
+
+
+async def get_image(session, image_id):
+    """Returns the `ImageWrapper` of an image"""
+
+    def get(conn):
+        conn.SERVICE_OPTS.setOmeroGroup("-1")
+        return conn.getObject("Image", image_id)
+
+    return await session.call(get)
+
+
+async def get_roi_thumb(session, image, roi, **kwargs):
+    """See `roi_utils.get_roi_thumb`"""
+    return await session.call(roi_utils.get_roi_thumb, image, roi, **kwargs)
+
+
+async def get_roi_thumbs(session, image, rois, **kwargs):
+    """See `roi_utils.get_roi_thumbs`"""
+    return await session.call(roi_utils.get_roi_thumbs, image, rois, **kwargs)
+
+
+async def get_rois_as_labels(session, image, **kwargs):
+    """See `roi_utils.get_rois_as_labels`"""
+    return await session.call(
+        lambda conn: roi_utils.get_rois_as_labels(image, conn, **kwargs)
+    )
+
+
+async def register_shape_to_roi(session, image, polygon, **kwargs):
+    """See `roi_utils.register_shape_to_roi`"""
+    return await session.call(
+        lambda conn: roi_utils.register_shape_to_roi(image, polygon, conn, **kwargs)
+    )
+
+
+async def register_polygons(session, image, polygons, **kwargs):
+    """See `roi_utils.register_polygons`, the chunks are saved one at a time
+    with a pooled connection
+    """
+    return await session.call(
+        lambda conn: roi_utils.register_polygons(image, polygons, conn, **kwargs)
+    )
+
+
+async def get_thumbnails(session, image_ids, **kwargs):
+    """See `images.get_thumbnails`"""
+    return await session.call(
+        lambda conn: images.get_thumbnails(image_ids, conn, **kwargs)
+    )
@@ -0,0 +1,344 @@
+"""Local caches for data retrieved from an OMERO server
+
+"""
+import os
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "omero_utils"
+
+
+class DiskCache:
+    """Size bounded file store with least recently used eviction.
+
+    Each entry is stored in its own file, named after a hash of its key.
+    Recency is recorded in the files modification time, so the
+    eviction order survives between sessions.
+
+    Attributes
+    ----------
+    directory : `pathlib.Path`, where the files are stored
+    max_bytes : int, the size budget of the cache on disk
+    nbytes : int, the current size of the cache on disk
+    hits, misses, evictions : ints, usage counters
+
+    """
+
+    suffix = ""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+
+        existing = sorted(
+            (p.stat().st_mtime, p.name, p.stat().st_size)
+            for p in self.directory.glob(f"*{self.suffix}")
+        )
+        for _, name, size in existing:
+            self._entries[name] = size
+            self.nbytes += size
+        self._evict()
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return self.directory / f"{digest}{self.suffix}"
+
+    def _lookup(self, key):
+        """Returns the path of the entry for `key`, or None if it is not
+        cached, and records the access
+        """
+        path = self._path(key)
+        with self._lock:
+            if path.name not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(path.name)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def _store(self, key, write):
+        """Stores an entry for `key`, `write` being a function writing
+        the entry content in the open binary file it is passed.
+        """
+        path = self._path(key)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as fh:
+            write(fh)
+        size = tmp.stat().st_size
+        if size > self.max_bytes:
+            tmp.unlink()
+            return None
+        os.replace(tmp, path)
+        with self._lock:
+            self.nbytes += size - self._entries.pop(path.name, 0)
+            self._entries[path.name] = size
+            self._evict()
+        return path
+
+    def _evict(self):
+        with self._lock:
+            while self.nbytes > self.max_bytes and self._entries:
+                name, size = self._entries.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+                try:
+                    (self.directory / name).unlink()
+                except OSError:
+                    pass
+
+    def _discard(self, path):
+        """Forgets about an entry found unreadable after a hit"""
+        with self._lock:
+            self.nbytes -= self._entries.pop(path.name, 0)
+            self.hits -= 1
+            self.misses += 1
+
+    def __contains__(self, key):
+        return self._path(key).name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Returns a dictionnary with the cache usage counters"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """Removes all the entries from the cache"""
+        with self._lock:
+            for name in self._entries:
+                try:
+                    (self.directory / name).unlink()
+                except OSError:
+                    pass
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class PlaneCache(DiskCache):
+    """On disk cache of image planes and tiles, stored as `.npy` files.
+
+    Cached arrays are served as read-only memory maps, so a hit costs
+    no copy and only the parts of the array actually used are read from disk.
+
+    Usage
+    -----
+    .. code-block:: python
+        cache = PlaneCache(max_bytes=20 * 2**30)
+        with imageio.OmeroImageReader(im_id, conn, cache=cache) as image_reader:
+            plane = image_reader.get_plane(0, 0, 0)
+        print(cache.stats())
+
+    """
+
+    suffix = ".npy"
+
+    def __init__(self, directory=None, max_bytes=2 ** 32):
+        """
+        Parameters
+        ----------
+        directory : str or Path, optional
+            where to store the planes, defaults to `~/.cache/omero_utils/planes`
+        max_bytes : int, default 4 GiB
+            the size budget on disk, least recently used planes are
+            removed above this size
+
+        """
+        if directory is None:
+            directory = DEFAULT_CACHE_DIR / "planes"
+        super().__init__(directory, max_bytes)
+
+    def get(self, key):
+        """Returns the cached array for `key` as a read-only memory map,
+        or None if it is not in the cache
+        """
+        path = self._lookup(key)
+        if path is None:
+            return None
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            # evicted in the meantime or corrupted
+            self._discard(path)
+            return None
+
+    def put(self, key, array):
+        """Stores `array` in the cache under `key`"""
+        self._store(key, lambda fh: np.save(fh, np.asarray(array)))
+
+
+class TextStore(DiskCache):
+    """On disk cache of utf-8 strings"""
+
+    suffix = ".txt"
+
+    def get(self, key):
+        """Returns the cached string for `key` or None"""
+        path = self._lookup(key)
+        if path is None:
+            return None
+        try:
+            return path.read_text(encoding="utf-8")
+        except OSError:
+            self._discard(path)
+            return None
+
+    def put(self, key, text):
+        """Stores `text` in the cache under `key`"""
+        self._store(key, lambda fh: fh.write(text.encode("utf-8")))
+
+
+class ThumbCache:
+    """In memory cache of HTML thumbnails with a memory budget and least
+    recently used eviction, optionally backed by an on disk store shared
+    across sessions and widgets.
+
+    Keys should identify the thumbnail across sessions, e.g.
+    (server, image id, roi id, render parameters).
+
+    Usage
+    -----
+    .. code-block:: python
+        cache = ThumbCache(directory="~/.cache/omero_utils/thumbs")
+        isv = ImageScatterViz(data, thumb_cache=cache)
+        # later, in another notebook, thumbnails are read from disk
+        isv = ImageScatterViz(data, thumb_cache=ThumbCache(directory=...))
+
+    """
+
+    def __init__(self, max_bytes=2 ** 26, directory=None, max_disk_bytes=2 ** 30):
+        """
+        Parameters
+        ----------
+        max_bytes : int, default 64 MiB
+            the memory budget
+        directory : str or Path, optional
+            if given, thumbnails are also stored in this directory
+        max_disk_bytes : int, default 1 GiB
+            the size budget on disk
+
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+        if directory is not None:
+            self.store = TextStore(Path(directory).expanduser(), max_disk_bytes)
+        else:
+            self.store = None
+
+    def _remember(self, key, value):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._items[key] = value
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def get(self, key, default=None):
+        """Returns the thumbnail for `key` from memory or disk,
+        or `default` if it is not cached
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.store is not None:
+            value = self.store.get(key)
+            if value is not None:
+                self._remember(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._remember(key, value)
+        if self.store is not None:
+            self.store.put(key, value)
+
+    def setdefault(self, key, value):
+        current = self.get(key)
+        if current is not None:
+            return current
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._items:
+                return True
+        return self.store is not None and key in self.store
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """Returns a dictionnary with the cache usage counters,
+        the disk store counters are under the "disk" key
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._items),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+        if self.store is not None:
+            stats["disk"] = self.store.stats()
+        return stats
+
+    def clear(self):
+        """Removes all the thumbnails from memory and disk"""
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+        if self.store is not None:
+            self.store.clear()
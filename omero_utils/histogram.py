@@ -0,0 +1,234 @@
+"""Streaming intensity histograms and percentiles
+
+Histograms are updated one plane or tile at a time, so percentiles of a
+whole stack are computed in a single pass without holding it in memory.
+
+Usage
+-----
+.. code-block:: python
+    with imageio.OmeroImageReader(image_id, conn) as reader:
+        hist = reader.histogram(c=0)
+        low, high = hist.percentile([1, 99.8])
+        plane = normalize(reader.get_plane(0, 12, 0), hist, 1, 99.8)
+
+"""
+import numpy as np
+
+
+EXACT_KINDS = ("int8", "uint8", "int16", "uint16", "bool")
+"""Data types whose histograms are exact bin counts, one bin per value"""
+COARSE_FRACTION = 0.05
+"""A message is printed when a percentile falls in a bin wider than one
+value holding more than this fraction of the values"""
+
+
+class Histogram:
+    """Streaming histogram of the values of an image.
+
+    For 8 and 16 bits integers, there is one bin per possible value,
+    filled with `np.bincount`, and percentiles are exact. For other data
+    types, the histogram has `n_bins` bins of equal width, and the bin
+    width doubles whenever new values fall outside of the covered range,
+    so the memory is bounded and the percentiles are approximated within
+    the final bin width. For 32 bits integers, the bins are one value wide
+    while the values span less than `n_bins`, so percentiles are exact,
+    and a power of two wide beyond.
+
+    Attributes
+    ----------
+    counts : `np.ndarray` of ints, the number of values in each bin
+    count : int, the number of values seen
+    min, max : the extreme values seen
+
+    """
+
+    def __init__(self, dtype, n_bins=4096):
+        """
+        Parameters
+        ----------
+        dtype : numpy dtype of the values
+        n_bins : int, default 4096
+            number of bins for data types without an exact histogram,
+            rounded up to an even number
+
+        """
+        self.dtype = np.dtype(dtype)
+        self.exact = self.dtype.name in EXACT_KINDS
+        self.integer = self.dtype.kind in "iu"
+        self.count = 0
+        self.min = None
+        self.max = None
+        if self.exact:
+            info = np.iinfo(self.dtype) if self.dtype.kind != "b" else None
+            self.offset = int(info.min) if info else 0
+            self.counts = np.zeros(
+                int(info.max) - self.offset + 1 if info else 2, dtype=np.int64
+            )
+            self.low, self.width = self.offset, 1
+        else:
+            self.counts = np.zeros(n_bins + n_bins % 2, dtype=np.int64)
+            self.low, self.width = None, None
+
+    @property
+    def edges(self):
+        """The left edges of the bins"""
+        return self.low + self.width * np.arange(self.counts.size)
+
+    def update(self, data):
+        """Adds the values of the `data` array to the histogram,
+        NaN and infinite values are ignored
+        """
+        data = np.asarray(data).ravel()
+        if not self.exact and data.dtype.kind == "f":
+            data = data[np.isfinite(data)]
+        if not data.size:
+            return
+        low, high = data.min(), data.max()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.count += data.size
+
+        if self.exact:
+            if self.offset:
+                data = data.astype(np.int32) - self.offset
+            self.counts += np.bincount(data, minlength=self.counts.size)
+            return
+
+        self._cover(float(low), float(high))
+        index = ((data - self.low) / self.width).astype(np.intp)
+        np.clip(index, 0, self.counts.size - 1, out=index)
+        self.counts += np.bincount(index, minlength=self.counts.size)
+
+    def _cover(self, low, high):
+        """Doubles the bin width until [low, high] is in the histogram range"""
+        n_bins = self.counts.size
+        if self.low is None and self.integer:
+            # whole bins, the doubling below keeps them whole
+            self.low, self.width = np.floor(low), 1.0
+        elif self.low is None:
+            self.low = low
+            # the highest value must fall in the last bin
+            width = (high - low) / n_bins * (1 + 1e-9)
+            self.width = max(width, np.finfo(float).tiny)
+            return
+        while low < self.low or high >= self.low + self.width * n_bins:
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            empty = np.zeros(n_bins // 2, dtype=np.int64)
+            if low < self.low:
+                # extend the range to the left
+                self.counts = np.concatenate((empty, merged))
+                self.low -= self.width * n_bins
+            else:
+                self.counts = np.concatenate((merged, empty))
+            self.width *= 2
+
+    def merge(self, other):
+        """Adds the counts of another histogram of the same data type"""
+        if other.count == 0:
+            return
+        if self.exact:
+            self.counts += other.counts
+        else:
+            n_bins = self.counts.size
+            self._cover(other.low, other.low + other.width * (n_bins - 1))
+            centers = other.edges + other.width / 2
+            index = ((centers - self.low) / self.width).astype(np.intp)
+            np.clip(index, 0, n_bins - 1, out=index)
+            counts = np.bincount(index, weights=other.counts, minlength=n_bins)
+            self.counts += counts.astype(np.int64)
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        """Returns the `q` quantile(s) of the values, `q` being between 0 and 1.
+
+        As `np.quantile` with the default linear interpolation between the
+        closest ranks, exact for exact histograms. For the others, values
+        are assumed evenly spread in their bin.
+        """
+        if not self.count:
+            raise ValueError("Empty histogram")
+        q = np.asarray(q, dtype=float)
+        rank = q * (self.count - 1)
+        below = np.floor(rank)
+        if not self.resolved:
+            self._check_resolution(rank)
+        low_value = self._value_at(below)
+        high_value = self._value_at(np.minimum(below + 1, self.count - 1))
+        values = low_value + (rank - below) * (high_value - low_value)
+        return np.clip(values, self.min, self.max)
+
+    def percentile(self, p):
+        """Returns the `p` percentile(s) of the values, see `Histogram.quantile`"""
+        return self.quantile(np.asarray(p, dtype=float) / 100)
+
+    @property
+    def resolved(self):
+        """True if each bin holds a single value, so quantiles are exact"""
+        return self.exact or (self.integer and self.width == 1)
+
+    def _check_resolution(self, rank):
+        """Prints a message if the `rank`-th values fall in bins holding
+        more than `COARSE_FRACTION` of the values, their spread inside the
+        bins being unknown
+        """
+        cumulated = np.cumsum(self.counts)
+        bins = np.searchsorted(cumulated, rank, side="right")
+        crowded = self.counts[bins].max() / self.count
+        if crowded > COARSE_FRACTION:
+            print(
+                f"Approximate quantiles: a bin {self.width:.4g} wide holds "
+                f"{crowded:.0%} of the values, use more bins for a better estimate"
+            )
+
+    def _value_at(self, rank):
+        """Returns the value of the `rank`-th (from 0) smallest value"""
+        cumulated = np.cumsum(self.counts)
+        bins = np.searchsorted(cumulated, rank, side="right")
+        if self.resolved:
+            return (bins * self.width + self.low).astype(float)
+        # position of the rank inside its bin
+        before = np.where(bins > 0, cumulated[np.maximum(bins - 1, 0)], 0)
+        inside = (rank - before + 0.5) / self.counts[bins]
+        return self.low + self.width * (bins + inside)
+
+    def window(self, pmin=1, pmax=99.8):
+        """Returns the (`pmin`, `pmax`) percentiles as a pair of floats, e.g.
+        as the intensity window of `roi_utils.html_thumb`
+        """
+        low, high = self.percentile([pmin, pmax])
+        return float(low), float(high)
+
+    def __repr__(self):
+        kind = "exact" if self.resolved else f"{self.counts.size} bins"
+        return f"<Histogram {self.dtype} ({kind}) of {self.count} values>"
+
+
+def normalize(
+    data, histogram, pmin=1, pmax=99.8, clip=False, eps=1e-20, dtype=np.float32
+):
+    """Percentile based normalization of `data`, with the percentiles
+    of a `Histogram`, e.g. of the whole stack, so that `pmin` is mapped
+    to 0 and `pmax` to 1, as `csbdeep.utils.normalize` does.
+
+    Parameters
+    ----------
+    data : `np.ndarray`
+    histogram : `Histogram`
+    pmin, pmax : floats, default 1 and 99.8
+        the low and high percentiles
+    clip : bool, default False
+        whether to clip the result to [0, 1]
+    eps : float, default 1e-20
+        added to the denominator
+    dtype : numpy dtype, default float32
+
+    """
+    low, high = histogram.window(pmin, pmax)
+    out = np.asarray(data).astype(dtype)
+    out -= low
+    out /= high - low + eps
+    if clip:
+        np.clip(out, 0, 1, out=out)
+    return out
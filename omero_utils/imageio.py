@@ -1,5 +1,15 @@
+import queue
+import weakref
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import product, islice
+
 import numpy as np
-from itertools import product
+
+from .pool import SessionPool
+from .histogram import Histogram, normalize
+from .stats import CallStats, STATS, instrument, get_stats
 
 
 class ImageReader:
@@ -21,11 +31,27 @@ class ImageReader:
         "ChannelLabels": ["R", "G", "B"],
     }
 
-    def __init__(self, image=None):
+    batch_size = 1
+    prefetch = 0
+    id = 0
+
+    def __init__(self, image=None, metadata=None):
 
         self.image = image
-        self.id = 0
-        self.metadata = self.get_metadata()
+        self._metadata = metadata
+        # background reads, stopped before the connection is released
+        self._streams = weakref.WeakSet()
+
+    @property
+    def metadata(self):
+        """The image metadata, computed by `get_metadata` on first access"""
+        if self._metadata is None:
+            self._metadata = self.get_metadata()
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
 
     def __enter__(self):
         return self
@@ -36,12 +62,280 @@ class ImageReader:
     def get_plane(self, c, z, t):
         raise NotImplementedError
 
+    def get_planes(self, czts):
+        """Yields the planes for each (c, z, t) tuple in `czts`, in order.
+
+        Sub-classes able to fetch several planes at once should override this.
+        """
+        for czt in czts:
+            yield self.get_plane(*czt)
+
+    def get_tiles(self, czt_tiles):
+        """Yields the tiles for each (c, z, t, (x, y, width, height)) tuple
+        in `czt_tiles`, in order.
+
+        Sub-classes able to fetch image regions should override this.
+        """
+        for c, z, t, (x, y, w, h) in czt_tiles:
+            yield self.get_plane(c, z, t)[y : y + h, x : x + w]
+
+    @property
+    def dtype(self):
+        """The numpy dtype of the image planes"""
+        return self.get_plane(0, 0, 0).dtype
+
+    def as_array(self):
+        """Returns a lazy (t, c, z, y, x) array-like view of the image,
+        see `LazyImageArray`
+        """
+        return LazyImageArray(self)
+
+    def iter_planes(self, czts=None, batch_size=None, prefetch=None):
+        """Iterates over ((c, z, t), plane) pairs, fetching the planes
+        by chunks of `batch_size`.
+
+        Parameters
+        ----------
+        czts : iterable of (c, z, t) tuples, optional
+            the planes to read, defaults to the whole stack
+        batch_size : int, optional
+            number of planes fetched per call to `get_planes`,
+            defaults to `self.batch_size`
+        prefetch : int, optional
+            number of chunks read ahead in a background thread while the
+            current one is processed, defaults to `self.prefetch`.
+            At most `(prefetch + 2) * batch_size` planes are held in memory.
+            Set to 0 to read synchronously.
+
+        """
+        if czts is None:
+            czts = product(
+                range(self.metadata["SizeC"]),
+                range(self.metadata["SizeZ"]),
+                range(self.metadata["SizeT"]),
+            )
+        batch_size = self.batch_size if batch_size is None else batch_size
+        prefetch = self.prefetch if prefetch is None else prefetch
+
+        def fetch():
+            for chunk in chunked(czts, batch_size):
+                yield chunk, list(self.get_planes(chunk))
+
+        for chunk, planes in self._track(background_iter(fetch(), prefetch)):
+            yield from zip(chunk, planes)
+
     def __iter__(self):
-        size_c = self.metadata["SizeC"]
-        size_z = self.metadata["SizeZ"]
-        size_t = self.metadata["SizeT"]
-        for czt in product(range(size_c), range(size_z), range(size_t)):
-            yield czt, self.get_plane(*czt)
+        return self.iter_planes()
+
+    def _stream(self, get_many, items, batch_size, prefetch):
+        """Yields (item, array) pairs for the `items` read by chunks of
+        `batch_size` with `get_many` (`get_planes` or `get_tiles`), handing
+        the arrays over one at a time: at most `prefetch + 3` of them (the
+        ones queued, the one being read, and the current and previous ones
+        of the caller) are held in memory, whatever the batch size.
+        """
+
+        def fetch():
+            for chunk in chunked(items, batch_size):
+                yield from zip(chunk, get_many(chunk))
+
+        return self._track(background_iter(fetch(), prefetch))
+
+    def _track(self, stream):
+        """Registers a `background_iter` generator, closed by `_close_streams`"""
+        self._streams.add(stream)
+        return stream
+
+    def _close_streams(self):
+        """Stops the background reads still running, waiting for the
+        server calls in progress, so that the connection is not used
+        once given back or closed
+        """
+        for stream in list(self._streams):
+            try:
+                stream.close()
+            except ValueError:
+                # being iterated in another thread, it stops on its own
+                pass
+
+    def histograms(
+        self,
+        channels=None,
+        z=None,
+        t=None,
+        tile_size=None,
+        n_bins=4096,
+        batch_size=None,
+        prefetch=1,
+    ):
+        """Returns the intensity histograms of the channels, computed in
+        a single pass over the planes (or tiles), see `histogram.Histogram`.
+        As with `ImageReader.project`, at most `prefetch + 3` planes, or
+        tiles, are held in memory.
+
+        Histograms are cached per image, see `cached_histogram`, so they
+        are only computed once, and must not be modified.
+
+        Parameters
+        ----------
+        channels : list of ints, optional
+            defaults to all the channels
+        z, t : ints, optional
+            if given, only this Z plane (resp. time point) is used
+        tile_size : int or (int, int), optional
+            if given, the planes are read by tiles of this size
+        n_bins : int, default 4096
+            number of bins for the data types without exact histograms
+        batch_size, prefetch : ints, optional
+            see `ImageReader.project`
+
+        Returns
+        -------
+        histograms : dict with the channels as keys and `Histogram` as values
+
+        """
+        if channels is None:
+            channels = range(self.metadata["SizeC"])
+        histograms = {
+            c: cached_histogram(self._histogram_key(c, z, t, n_bins))
+            for c in channels
+        }
+        missing = [c for c, hist in histograms.items() if hist is None]
+        if missing:
+            zs = range(self.metadata["SizeZ"]) if z is None else [z]
+            ts = range(self.metadata["SizeT"]) if t is None else [t]
+            czts = list(product(missing, zs, ts))
+            computed = {c: Histogram(self.dtype, n_bins) for c in missing}
+            batch_size = self.batch_size if batch_size is None else batch_size
+            if tile_size is None:
+                stream = self._stream(self.get_planes, czts, batch_size, prefetch)
+            else:
+                size_x, size_y = self.metadata["SizeX"], self.metadata["SizeY"]
+                czt_tiles = [
+                    (c, z, t, tile)
+                    for c, z, t in czts
+                    for tile, _ in tile_grid(size_x, size_y, tile_size)
+                ]
+                stream = self._stream(self.get_tiles, czt_tiles, batch_size, prefetch)
+            for (c, *_), data in stream:
+                computed[c].update(data)
+            for c, hist in computed.items():
+                cache_histogram(self._histogram_key(c, z, t, n_bins), hist)
+            histograms.update(computed)
+        return histograms
+
+    def _histogram_key(self, c, z, t, n_bins):
+        """Key of a channel histogram in the histograms cache,
+        None for images without an identity on a server
+        """
+        return None
+
+    def histogram(self, c=0, **kwargs):
+        """Returns the intensity histogram of channel `c`,
+        see `ImageReader.histograms` for the keyword arguments
+        """
+        return self.histograms([c], **kwargs)[c]
+
+    def normalize(self, data, c=0, pmin=1, pmax=99.8, clip=False, **kwargs):
+        """Percentile based normalization of `data`, with the percentiles
+        of the whole channel `c`, see `histogram.normalize`.
+        Other keyword arguments are passed to `ImageReader.histograms`.
+
+        Example
+        -------
+        .. code-block:: python
+            with imageio.OmeroImageReader(im_id, conn) as image_reader:
+                for (c, z, t), plane in image_reader:
+                    plane = image_reader.normalize(plane, c, 1, 99.8)
+
+        """
+        hist = self.histogram(c, **kwargs)
+        return normalize(data, hist, pmin=pmin, pmax=pmax, clip=clip)
+
+    def project(
+        self,
+        axis="z",
+        op="max",
+        c=0,
+        z=0,
+        t=0,
+        tile_size=None,
+        batch_size=None,
+        prefetch=1,
+    ):
+        """Projects the stack along Z or T, streaming the planes and folding
+        them in place. Besides the projection (and for "mean" and "std"
+        its float64 accumulators), at most `prefetch + 3` planes, or tiles,
+        are held in memory, whatever the stack size and `batch_size`.
+
+        Parameters
+        ----------
+        axis : {"z", "t"}, default "z"
+            the axis along which to project
+        op : {"max", "min", "sum", "mean", "std"}, default "max"
+            the projection, "std" being the population standard deviation
+        c, z, t : ints, default 0
+            the position of the projected planes along the other axes,
+            `z` (resp. `t`) is ignored when projecting along Z (resp. T)
+        tile_size : int or (int, int), optional
+            if given, the planes are read by tiles of this size, for planes
+            too large to be read at once. The projection is still returned
+            as a whole plane.
+        batch_size : int, optional
+            number of planes, or tiles, read per server call, defaults
+            to `self.batch_size`. The planes of a call are handed over one
+            at a time, so they do not all stay in memory.
+        prefetch : int, default 1
+            number of planes, or tiles, read ahead in a background thread
+            while the current one is folded, 0 to read synchronously
+
+        Returns
+        -------
+        projection : `np.ndarray` of shape (SizeY, SizeX), with the image
+            dtype for "max" and "min", float64 otherwise
+
+        Example
+        -------
+        .. code-block:: python
+            with imageio.OmeroImageReader(im_id, conn) as image_reader:
+                mip = image_reader.project("z", "max", c=1)
+
+        """
+        if op not in PROJECTIONS:
+            raise ValueError(f"Unknown projection {op!r}, choose among {PROJECTIONS}")
+        if axis == "z":
+            czts = [(c, zi, t) for zi in range(self.metadata["SizeZ"])]
+        elif axis == "t":
+            czts = [(c, z, ti) for ti in range(self.metadata["SizeT"])]
+        else:
+            raise ValueError(f"axis should be 'z' or 't', not {axis!r}")
+
+        batch_size = self.batch_size if batch_size is None else batch_size
+        if tile_size is None:
+            projection = _Projection(op)
+            for _, plane in self._stream(self.get_planes, czts, batch_size, prefetch):
+                projection.add(plane)
+            return projection.result()
+
+        size_x, size_y = self.metadata["SizeX"], self.metadata["SizeY"]
+        tiles = [tile for tile, _ in tile_grid(size_x, size_y, tile_size)]
+        # a single stream for all the tiles, so that the next tile is
+        # read while the last planes of the current one are reduced
+        czt_tiles = [(c, z, t, tile) for tile in tiles for c, z, t in czts]
+        stream = (
+            data
+            for _, data in self._stream(self.get_tiles, czt_tiles, batch_size, prefetch)
+        )
+        out = None
+        for x, y, w, h in tiles:
+            projection = _Projection(op)
+            for data in islice(stream, len(czts)):
+                projection.add(data)
+            result = projection.result()
+            if out is None:
+                out = np.empty((size_y, size_x), dtype=result.dtype)
+            out[y : y + h, x : x + w] = result
+        return out
 
     def __exit__(self, exc_type, exc_value, traceback):
         raise NotImplementedError
@@ -56,11 +350,22 @@ class OmeroImageReader(ImageReader):
     conn : a `BlitzGateway` connection
     image : the OMERO Image object
     pixels : the OMERO Pixels object
+    stats : `omero_utils.stats.CallStats`, the server calls of the reader
 
 
     """
 
-    def __init__(self, image_id=None, conn=None):
+    def __init__(
+        self,
+        image_id=None,
+        conn=None,
+        batch_size=16,
+        prefetch=2,
+        cache=None,
+        pool=None,
+        metadata=None,
+        stats=None,
+    ):
         """Creates and OmeroImageReader instance.
 
         Parameters
@@ -69,6 +374,27 @@ class OmeroImageReader(ImageReader):
             The image identifier in the omero database
         conn :
             A BlitzGateway connection instance (will be connected at instanciation)
+        batch_size : int, default 16
+            number of planes retrieved per server call when iterating
+        prefetch : int, default 2
+            number of batches fetched ahead in a background thread
+            when iterating (0 to disable)
+        cache : `omero_utils.cache.PlaneCache`, optional
+            if provided, planes and tiles are first looked up in this
+            local cache, and stored there after being retrieved. Cached
+            planes are returned as read-only memory mapped arrays.
+        pool : `omero_utils.pool.SessionPool`, optional
+            if provided, a connection is borrowed from the pool instead
+            of using `conn`, and given back to the pool on exit instead
+            of being closed
+        metadata : dict, optional
+            the image metadata, e.g. from `images.get_images_metadata`.
+            If not provided, it is retrieved from the server on first
+            access to `self.metadata`
+        stats : `omero_utils.stats.CallStats`, optional
+            where the server calls are recorded, e.g. to share statistics
+            between readers. Defaults to a new `CallStats` forwarding to
+            the process wide `omero_utils.stats.STATS`
 
         Usage
         -----
@@ -92,25 +418,64 @@ class OmeroImageReader(ImageReader):
 
             # conn is closed outside of the context manager
 
+        To process many images, borrow connections from a
+        `omero_utils.pool.SessionPool` rather than logging in for each image:
+
+        .. code-block:: python
+            pool = SessionPool(conn)
+            for im_id in image_ids:
+                with imageio.OmeroImageReader(im_id, pool=pool) as image_reader:
+                    do_something
+            # the connection went back to the pool
 
+        Planes are retrieved `batch_size` at a time, and the next batch
+        is fetched in the background while the current one is processed,
+        see `ImageReader.iter_planes`.
 
         """
         print(f"Treating {image_id}")
         self.id = image_id
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.cache = cache
+        self.pool = pool
+        if pool is not None:
+            conn = pool.acquire()
         self.conn = conn
-        self.conn.connect()
-        self.conn.SERVICE_OPTS.setOmeroGroup("-1")
-        self.image = conn.getObject("Image", oid=image_id)
-        self.pixels = self.image.getPrimaryPixels()
-        super().__init__(self.image)
+        if stats is None:
+            stats = CallStats(f"image {image_id}", parent=STATS)
+        self.stats = stats
+        try:
+            if not self.conn.isConnected():
+                self.conn.connect()
+            self.conn.SERVICE_OPTS.setOmeroGroup("-1")
+            # the image and pixels are proxies recording their remote calls
+            self.image = instrument(conn, stats).getObject("Image", oid=image_id)
+            if self.image is None:
+                raise ValueError(f"Image {image_id} not found or not accessible")
+            self.pixels = self.image.getPrimaryPixels()
+        except BaseException:
+            # the borrowed connection would never be given back
+            if pool is not None:
+                pool.release(conn)
+            raise
+        super().__init__(self.image, metadata=metadata)
+        self._levels = None
 
     def __enter__(self):
         return self
 
+    @property
+    def dtype(self):
+        """The numpy dtype of the image planes"""
+        return np.dtype(PIXEL_TYPES[self.pixels.getPixelsType().value])
+
     def get_metadata(self):
         """Returns a dictionnary with the image metadata
         with keys:
 
+        * "SizeX"
+        * "SizeY"
         * "SizeZ"
         * "SizeC"
         * "SizeT"
@@ -124,6 +489,9 @@ class OmeroImageReader(ImageReader):
         The last two keys are set only if `self.image.getObjectiveSettings()`
         returns an `ObjectiveSettings` instance.
 
+        This is called on first access to `self.metadata`. To retrieve the
+        metadata of many images at once, use `images.get_images_metadata`.
+
         See Also
         --------
         https://docs.openmicroscopy.org/omero-blitz/5.5.5/slice2html/omero/model/Image.html
@@ -138,6 +506,8 @@ class OmeroImageReader(ImageReader):
 
         sizex = self.pixels.getPhysicalSizeX()
         metadata = {
+            "SizeX": self.image.getSizeX(),
+            "SizeY": self.image.getSizeY(),
             "SizeZ": self.image.getSizeZ(),
             "SizeC": self.image.getSizeC(),
             "SizeT": self.image.getSizeT(),
@@ -161,7 +531,696 @@ class OmeroImageReader(ImageReader):
         return metadata
 
     def get_plane(self, c, z, t):
-        return self.pixels.getPlane(theC=c, theZ=z, theT=t)
+        if self.cache is None:
+            return self.pixels.getPlane(theC=c, theZ=z, theT=t)
+        return next(self.get_planes([(c, z, t)]))
+
+    def get_planes(self, czts):
+        """Yields the planes for each (c, z, t) tuple in `czts`,
+        reusing a single raw pixels store for all of them.
+        """
+        yield from self._cached_fetch(
+            [(c, z, t, None) for c, z, t in czts],
+            lambda czt_tiles: self.pixels.getPlanes(
+                [(z, c, t) for c, z, t, _ in czt_tiles]
+            ),
+        )
+
+    def get_tiles(self, czt_tiles):
+        """Yields the tiles for each (c, z, t, (x, y, width, height)) tuple
+        in `czt_tiles`, reusing a single raw pixels store for all of them.
+        """
+        yield from self._cached_fetch(
+            [(c, z, t, tuple(tile)) for c, z, t, tile in czt_tiles],
+            lambda czt_tiles: self.pixels.getTiles(
+                [(z, c, t, tile) for c, z, t, tile in czt_tiles]
+            ),
+        )
+
+    def _cache_key(self, c, z, t, tile):
+        server = (getattr(self.conn, "host", None), getattr(self.conn, "port", None))
+        return (server, self.id, c, z, t, tile)
+
+    def _histogram_key(self, c, z, t, n_bins):
+        server = (getattr(self.conn, "host", None), getattr(self.conn, "port", None))
+        return (server, self.pixels.getId(), c, z, t, n_bins)
+
+    def _cached_fetch(self, czt_tiles, fetch):
+        """Yields the arrays for each (c, z, t, tile) in `czt_tiles`,
+        retrieving the ones missing from the cache with a single call
+        to `fetch`
+        """
+        if self.cache is None:
+            yield from fetch(czt_tiles)
+            return
+
+        keys = [self._cache_key(*czt_tile) for czt_tile in czt_tiles]
+        cached = [self.cache.get(key) for key in keys]
+        fetched = fetch(
+            [czt_tile for czt_tile, arr in zip(czt_tiles, cached) if arr is None]
+        )
+        for key, arr in zip(keys, cached):
+            if arr is None:
+                arr = next(fetched)
+                self.cache.put(key, arr)
+            yield arr
+
+    def _raw_store(self):
+        return open_raw_store(instrument(self.conn, self.stats), self.pixels.getId())
+
+    @property
+    def levels(self):
+        """The (size_x, size_y) of the image resolution levels, from
+        the full resolution to the coarsest, see `resolution_levels`
+        """
+        if self._levels is None:
+            self._levels = get_resolution_levels(
+                instrument(self.conn, self.stats), self.pixels.getId()
+            )
+        return self._levels
+
+    def get_level_tiles(self, czt_tiles, level):
+        """Yields the tiles for each (c, z, t, (x, y, width, height)) tuple
+        in `czt_tiles`, in the coordinates of resolution `level`, reusing
+        a single raw pixels store for all of them.
+
+        Level 0 is the full resolution, see `OmeroImageReader.levels`.
+        """
+        czt_tiles = [(c, z, t, tuple(tile)) for c, z, t, tile in czt_tiles]
+        if level == 0:
+            yield from self.get_tiles(czt_tiles)
+            return
+
+        def fetch(czt_tiles):
+            if not czt_tiles:
+                return
+            store = self._raw_store()
+            try:
+                yield from read_level_tiles(
+                    store,
+                    self.dtype,
+                    [(c, z, t, tile[1:]) for c, z, t, tile in czt_tiles],
+                    level,
+                    len(self.levels),
+                )
+            finally:
+                store.close()
+
+        # the level is prepended to the tiles so that cache keys differ
+        yield from self._cached_fetch(
+            [(c, z, t, (level,) + tile) for c, z, t, tile in czt_tiles], fetch
+        )
+
+    def get_preview(self, c, z, t, size=512, region=None):
+        """Returns a (c, z, t) plane, or a region of it, read at the coarsest
+        resolution level where it is at least `size` pixels along its
+        longest side.
+
+        Parameters
+        ----------
+        c, z, t : ints
+        size : int, default 512
+            the minimum size of the preview longest side. The preview is
+            not resized to exactly this size.
+        region : (x, y, width, height) tuple, optional
+            in full resolution coordinates, defaults to the whole plane
+
+        Returns
+        -------
+        preview : `np.ndarray` of shape (height, width) at the chosen level
+        level : int, the resolution level, see `OmeroImageReader.levels`
+
+        """
+        levels = self.levels
+        if region is None:
+            region = (0, 0) + tuple(levels[0])
+        level = pick_level(levels, region[2], region[3], size)
+        tile = scale_region(region, levels, level)
+        return next(self.get_level_tiles([(c, z, t, tile)], level)), level
+
+    def iter_tiles(self, c, z, t, tile_size=1024, overlap=0, out=None, prefetch=None):
+        """Iterates over the tiles of the (c, z, t) plane, without ever
+        holding the whole plane in memory.
+
+        Parameters
+        ----------
+        c, z, t : ints
+            the plane position in the stack
+        tile_size : int or (int, int), default 1024
+            the tile (width, height), without overlap
+        overlap : int, default 0
+            number of pixels each tile extends over its neighbours
+            on every side (clipped at the plane borders)
+        out : array-like of shape (SizeY, SizeX), optional
+            if provided, the tiles are reassembled in this array as they
+            are read, e.g. a `np.memmap` for planes larger than memory
+        prefetch : int, optional
+            number of tiles read ahead in a background thread,
+            defaults to `self.prefetch`
+
+        Yields
+        ------
+        tile : tuple (x, y, width, height)
+            the region of the plane covered by the tile, overlap included
+        data : np.ndarray of shape (height, width)
+
+        Example
+        -------
+        .. code-block:: python
+            for (x, y, w, h), data in reader.iter_tiles(0, 0, 0, 2048, overlap=32):
+                process(data)
+
+        """
+        size_x, size_y = self.pixels.getSizeX(), self.pixels.getSizeY()
+        prefetch = self.prefetch if prefetch is None else prefetch
+        grid = list(tile_grid(size_x, size_y, tile_size, overlap))
+        tiles = self.get_tiles([(c, z, t, tile) for tile, _ in grid])
+
+        stream = self._track(background_iter(tiles, prefetch))
+        for (tile, core), data in zip(grid, stream):
+            if out is not None:
+                x, y, _, _ = tile
+                cx, cy, cw, ch = core
+                out[cy : cy + ch, cx : cx + cw] = data[
+                    cy - y : cy - y + ch, cx - x : cx - x + cw
+                ]
+            yield tile, data
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.conn.close()
+        self._close_streams()
+        if self.pool is not None:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+
+
+class LazyImageArray:
+    """Lazy 5D (t, c, z, y, x) array view over an image.
+
+    Indexing the view with the usual NumPy basic indexing (integers,
+    slices, ellipsis) only retrieves the planes it touches, and only the
+    bounding region of the y and x selection, with a single batched
+    call to the reader. Integer sequences are also accepted, and applied
+    independently on each axis (orthogonal indexing).
+
+    Usage
+    -----
+    .. code-block:: python
+        with imageio.OmeroImageReader(im_id, conn) as image_reader:
+            stack = image_reader.as_array()
+            # all z planes of the first channel, as a (z, y, x) ndarray
+            imgs = stack[0, 0]
+            # a sub-volume, only the region is transfered
+            sub = stack[0, 1, 10:20, 512:1024, 512:1024]
+
+    """
+
+    ndim = 5
+
+    def __init__(self, reader):
+        self.reader = reader
+        metadata = reader.metadata
+        self.shape = (
+            metadata["SizeT"],
+            metadata["SizeC"],
+            metadata["SizeZ"],
+            metadata["SizeY"],
+            metadata["SizeX"],
+        )
+        self.dtype = np.dtype(reader.dtype)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"<LazyImageArray shape={self.shape} dtype={self.dtype}>"
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[...]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __getitem__(self, key):
+        key = _expand_key(key, self.ndim)
+        ts, cs, zs, ys, xs = [_axis_indices(k, n) for k, n in zip(key, self.shape)]
+        out = np.empty((ts.size, cs.size, zs.size, ys.size, xs.size), self.dtype)
+
+        if out.size:
+            y0, x0 = ys.min(), xs.min()
+            height, width = ys.max() + 1 - y0, xs.max() + 1 - x0
+            local = (_as_slice(ys - y0), _as_slice(xs - x0))
+            if isinstance(local[0], np.ndarray) or isinstance(local[1], np.ndarray):
+                local = np.ix_(ys - y0, xs - x0)
+
+            # positions of each plane in the output, a plane can be repeated
+            positions = {}
+            for i, t in enumerate(ts):
+                for j, c in enumerate(cs):
+                    for k, z in enumerate(zs):
+                        positions.setdefault((c, z, t), []).append((i, j, k))
+            czts = list(positions)
+
+            if (height, width) == self.shape[3:]:
+                planes = self.reader.get_planes(czts)
+            else:
+                tile = (int(x0), int(y0), int(width), int(height))
+                planes = self.reader.get_tiles([czt + (tile,) for czt in czts])
+            for czt, plane in zip(czts, planes):
+                for ijk in positions[czt]:
+                    out[ijk] = plane[local]
+
+        squeeze = tuple(
+            0 if isinstance(k, (int, np.integer)) else slice(None) for k in key
+        )
+        return out[squeeze]
+
+
+def _expand_key(key, ndim):
+    """Returns `key` as a tuple of `ndim` indices, expanding ellipsis"""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is None for k in key):
+        raise IndexError("np.newaxis is not supported")
+    n_ellipsis = sum(k is Ellipsis for k in key)
+    if n_ellipsis > 1:
+        raise IndexError("an index can only have a single ellipsis ('...')")
+    if n_ellipsis:
+        pos = next(i for i, k in enumerate(key) if k is Ellipsis)
+        fill = (slice(None),) * (ndim - len(key) + 1)
+        key = key[:pos] + fill + key[pos + 1 :]
+    if len(key) > ndim:
+        raise IndexError(
+            f"too many indices: array is {ndim}-dimensional, "
+            f"but {len(key)} were indexed"
+        )
+    return key + (slice(None),) * (ndim - len(key))
+
+
+def _axis_indices(index, size):
+    """Returns the indices selected by `index` along an axis of length
+    `size` as an array of ints
+    """
+    if isinstance(index, slice):
+        return np.arange(*index.indices(size))
+
+    indices = np.asarray(index)
+    if indices.dtype == bool:
+        if indices.shape != (size,):
+            raise IndexError("boolean index does not match the axis length")
+        return np.flatnonzero(indices)
+    if indices.ndim > 1 or not np.issubdtype(indices.dtype, np.integer):
+        raise IndexError(f"unsupported index {index!r}")
+    indices = indices.reshape(-1)
+    if ((indices < -size) | (indices >= size)).any():
+        raise IndexError(f"index {index} is out of bounds for axis with size {size}")
+    return np.where(indices < 0, indices + size, indices)
+
+
+def _as_slice(indices):
+    """Returns a slice equivalent to the sorted, contiguous `indices`
+    if possible, else `indices`
+    """
+    if (np.diff(indices) == 1).all():
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+def read_many(
+    image_ids, pool, workers=4, max_pending=None, ordered=True, **reader_kwargs
+):
+    """Reads several images concurrently, each worker thread using its
+    own pooled connection.
+
+    Parameters
+    ----------
+    image_ids : iterable of ints
+        the images to read, e.g. from `images.get_images_from_instrument`
+    pool : `omero_utils.pool.SessionPool` or a `BlitzGateway` connection
+        if a connection is passed, a pool of `workers` connections
+        sharing its session is created for the duration of the reading
+    workers : int, default 4
+        number of images read in parallel
+    max_pending : int, optional
+        maximum number of images read but not yet consumed by the caller,
+        defaults to `2 * workers`. New reads are only started as the caller
+        consumes the results, so at most `max_pending + 1` images are held
+        in memory at once.
+    ordered : bool, default True
+        if True, the images are yielded in the order of `image_ids`,
+        else as soon as they are read
+    reader_kwargs :
+        passed to the `OmeroImageReader` constructor
+
+    Yields
+    ------
+    image_id : int
+    metadata : dict, see `OmeroImageReader.get_metadata`
+    planes : `np.ndarray` with shape (SizeT, SizeC, SizeZ, SizeY, SizeX)
+
+    Example
+    -------
+    .. code-block:: python
+        image_ids = images.get_images_from_instrument(instrument_id, conn)
+        for image_id, metadata, planes in read_many(image_ids, conn, workers=8):
+            do_something
+
+    """
+    own_pool = not isinstance(pool, SessionPool)
+    if own_pool:
+        pool = SessionPool(pool, size=workers)
+    if max_pending is None:
+        max_pending = 2 * workers
+    max_pending = max(max_pending, 1)
+
+    def read(image_id):
+        with OmeroImageReader(image_id, pool=pool, **reader_kwargs) as reader:
+            return image_id, reader.metadata, reader.as_array()[...]
+
+    image_ids = iter(image_ids)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit():
+        for image_id in islice(image_ids, max_pending - len(pending)):
+            pending.append(executor.submit(read, image_id))
+
+    try:
+        submit()
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            result = future.result()
+            del future
+            submit()
+            yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if own_pool:
+            pool.close()
+
+
+PROJECTIONS = ("max", "min", "sum", "mean", "std")
+
+
+class _Projection:
+    """In place accumulator of a projection over a sequence of planes,
+    the standard deviation is computed with Welford's algorithm
+    """
+
+    def __init__(self, op):
+        self.op = op
+        self.count = 0
+        self.acc = None
+        self.m2 = None
+
+    def add(self, plane):
+        self.count += 1
+        if self.acc is None:
+            if self.op in ("max", "min"):
+                self.acc = np.array(plane)
+            else:
+                self.acc = np.array(plane, dtype=np.float64)
+                if self.op == "std":
+                    self.m2 = np.zeros_like(self.acc)
+            return
+        if self.op == "max":
+            np.maximum(self.acc, plane, out=self.acc)
+        elif self.op == "min":
+            np.minimum(self.acc, plane, out=self.acc)
+        elif self.op == "std":
+            # acc is the running mean, m2 the sum of squared differences to it
+            delta = plane - self.acc
+            self.acc += delta / self.count
+            delta *= plane - self.acc
+            self.m2 += delta
+        else:
+            self.acc += plane
+
+    def result(self):
+        if self.op == "mean":
+            self.acc /= self.count
+        elif self.op == "std":
+            return np.sqrt(self.m2 / self.count)
+        return self.acc
+
+
+PIXEL_TYPES = {
+    "int8": np.int8,
+    "uint8": np.uint8,
+    "int16": np.int16,
+    "uint16": np.uint16,
+    "int32": np.int32,
+    "uint32": np.uint32,
+    "float": np.float32,
+    "double": np.float64,
+}
+
+
+def open_raw_store(conn, pixels_id):
+    """Returns a raw pixels store set on `pixels_id`, to be closed by the caller.
+    If `conn` is instrumented, so is the store, see `stats.instrument`.
+    """
+    stats = get_stats(conn)
+    factory = conn.c.sf
+    if stats is not None:
+        # the service factory is not reached through the gateway proxy
+        factory = instrument(factory, stats, kind="service")
+    store = factory.createRawPixelsStore()
+    if stats is not None:
+        store = instrument(store, stats, kind="service")
+    store.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+    return store
+
+
+LEVELS_CACHE_SIZE = 10_000
+"""Number of images whose resolution levels are kept by `get_resolution_levels`"""
+_levels_cache = OrderedDict()
+_levels_lock = threading.Lock()
+
+
+def get_resolution_levels(conn, pixels_id):
+    """Returns the resolution levels of the pixels `pixels_id`,
+    see `resolution_levels`. Levels are cached per server and pixels id,
+    for the `LEVELS_CACHE_SIZE` last used images, so the raw pixels store
+    is only opened once per image.
+    """
+    key = (getattr(conn, "host", None), getattr(conn, "port", None), pixels_id)
+    with _levels_lock:
+        levels = _levels_cache.get(key)
+        if levels is not None:
+            _levels_cache.move_to_end(key)
+            return levels
+    store = open_raw_store(conn, pixels_id)
+    try:
+        levels = resolution_levels(store)
+    finally:
+        store.close()
+    with _levels_lock:
+        _levels_cache[key] = levels
+        while len(_levels_cache) > LEVELS_CACHE_SIZE:
+            _levels_cache.popitem(last=False)
+    return levels
+
+
+HISTOGRAMS_CACHE_SIZE = 64
+"""Number of channel histograms kept by `cache_histogram`"""
+_histograms_cache = OrderedDict()
+_histograms_lock = threading.Lock()
+
+
+def cached_histogram(key):
+    """Returns the histogram cached under `key` by `cache_histogram`,
+    or None. Histograms are kept per server, pixels id, channel, Z and T
+    planes, and number of bins, for the `HISTOGRAMS_CACHE_SIZE` last used.
+    """
+    if key is None:
+        return None
+    with _histograms_lock:
+        hist = _histograms_cache.get(key)
+        if hist is not None:
+            _histograms_cache.move_to_end(key)
+        return hist
+
+
+def cache_histogram(key, hist):
+    """Caches a `histogram.Histogram` under `key`, not if it is None"""
+    if key is None:
+        return
+    with _histograms_lock:
+        _histograms_cache[key] = hist
+        while len(_histograms_cache) > HISTOGRAMS_CACHE_SIZE:
+            _histograms_cache.popitem(last=False)
+
+
+def clear_histograms_cache():
+    """Empties the cache of channel histograms"""
+    with _histograms_lock:
+        _histograms_cache.clear()
+
+
+def resolution_levels(store):
+    """Returns the (size_x, size_y) of each resolution level of the pixels
+    of a raw pixels `store`, from the full resolution to the coarsest.
+    Images without a pyramid have a single level.
+    """
+    return [(d.sizeX, d.sizeY) for d in store.getResolutionDescriptions()]
+
+
+def pick_level(levels, width, height, size):
+    """Returns the index in `levels` of the coarsest resolution level at which
+    a (width, height) full resolution region is at least `size` pixels
+    along its longest side, or 0 if even the full resolution is smaller.
+    """
+    full_x, full_y = levels[0]
+    best = 0
+    for i, (size_x, size_y) in enumerate(levels):
+        if max(width * size_x / full_x, height * size_y / full_y) >= size:
+            best = i
+    return best
+
+
+def scale_region(region, levels, level):
+    """Converts a full resolution (x, y, width, height) `region` to the
+    smallest region covering it at resolution `level`, clipped to the level
+    """
+    x, y, w, h = region
+    (full_x, full_y), (size_x, size_y) = levels[0], levels[level]
+    sx, sy = size_x / full_x, size_y / full_y
+    x0, y0 = int(np.floor(x * sx)), int(np.floor(y * sy))
+    x1 = min(max(int(np.ceil((x + w) * sx)), x0 + 1), size_x)
+    y1 = min(max(int(np.ceil((y + h) * sy)), y0 + 1), size_y)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def read_level_tiles(store, dtype, czt_tiles, level=0, n_levels=1):
+    """Yields the tiles for each (c, z, t, (x, y, width, height)) tuple in
+    `czt_tiles`, in the coordinates of resolution `level` (0 being the
+    full resolution, as in `resolution_levels`).
+
+    Regions larger than the store tile size are read tile by tile.
+    """
+    if n_levels > 1:
+        # the store numbers the levels from the coarsest one
+        store.setResolutionLevel(n_levels - 1 - level)
+    tile_w, tile_h = store.getTileSize()
+    # the server sends big endian data
+    raw_dtype = np.dtype(dtype).newbyteorder(">")
+    for c, z, t, (x, y, w, h) in czt_tiles:
+        out = np.empty((h, w), dtype=dtype)
+        for _, (cx, cy, cw, ch) in tile_grid(w, h, (tile_w, tile_h)):
+            raw = store.getTile(z, c, t, x + cx, y + cy, cw, ch)
+            out[cy : cy + ch, cx : cx + cw] = np.frombuffer(
+                raw, dtype=raw_dtype
+            ).reshape(ch, cw)
+        yield out
+
+
+def read_store_planes(store, dtype, czts, size_x, size_y):
+    """Yields the (size_y, size_x) planes of a raw pixels `store` for each
+    (c, z, t) tuple in `czts`, one server call per plane
+    """
+    raw_dtype = np.dtype(dtype).newbyteorder(">")
+    for c, z, t in czts:
+        raw = store.getPlane(z, c, t)
+        yield np.frombuffer(raw, dtype=raw_dtype).astype(dtype).reshape(size_y, size_x)
+
+
+def tile_grid(size_x, size_y, tile_size, overlap=0):
+    """Yields the tiles covering a (size_y, size_x) plane as pairs of
+    (x, y, width, height) tuples, the first one including `overlap` pixels
+    on each side, the second one without it.
+    """
+    if isinstance(tile_size, int):
+        tile_w = tile_h = tile_size
+    else:
+        tile_w, tile_h = tile_size
+
+    for cy in range(0, size_y, tile_h):
+        ch = min(tile_h, size_y - cy)
+        y = max(cy - overlap, 0)
+        h = min(cy + ch + overlap, size_y) - y
+        for cx in range(0, size_x, tile_w):
+            cw = min(tile_w, size_x - cx)
+            x = max(cx - overlap, 0)
+            w = min(cx + cw + overlap, size_x) - x
+            yield (x, y, w, h), (cx, cy, cw, ch)
+
+
+def chunked(iterable, size):
+    """Yields successive lists of at most `size` items from `iterable`
+    """
+    iterator = iter(iterable)
+    size = max(int(size), 1)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+_DONE = object()
+
+
+def background_iter(iterable, depth=2):
+    """Consumes `iterable` in a background thread, keeping at most `depth`
+    items ready ahead of the caller.
+
+    Exceptions raised while producing the items are re-raised in the
+    caller's thread. If the caller stops iterating early, closing the
+    generator waits for the background thread to finish the item it is
+    currently producing, so that the resources it uses can be released
+    safely afterwards.
+
+    If `depth` is 0, `iterable` is consumed synchronously.
+    """
+    if not depth:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as err:
+            if not put((_DONE, err)):
+                print(f"Error in a background read after it was stopped: {err!r}")
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        if worker is not threading.current_thread():
+            worker.join()
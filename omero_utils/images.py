@@ -1,19 +1,329 @@
-import omero
+from datetime import datetime
+
+import numpy as np
+from omero.rtypes import rint, rlong, rtime, unwrap
+from omero.sys import ParametersI
+
+from .imageio import background_iter
+
+
+IMAGE_COLUMNS = {
+    "name": ("i.name", None),
+    "description": ("i.description", None),
+    "acquisition_date": ("i.acquisitionDate", None),
+    "instrument": ("ins.id", "left outer join i.instrument ins"),
+    "fileset": ("fs.id", "left outer join i.fileset fs"),
+    "owner": ("i.details.owner.id", None),
+    "group": ("i.details.group.id", None),
+}
+"""Columns available in `iter_images`, as (HQL expression, join) pairs"""
+
+DATE_COLUMNS = {"acquisition_date"}
 
 
 def get_images_from_instrument(instrument_id, conn):
     """Returns a list of images ids
 
-    Parameters;
+    Parameters
+    ----------
+    instrument_id : int
+    conn : a `BlitzGateway` connection
+
+    See Also
+    --------
+    `iter_images` to stream the ids instead
 
     """
-    conn.SERVICE_OPTS.setOmeroGroup("-1")
-    params = omero.sys.Parameters()
-    params.map = {"instrument": rlong(instrument_id)}
-    queryService = conn.getQueryService()
-    images = queryService.projection(
-        "select i.id from Image i where i.instrument.id=:instrument",
-        params,
-        conn.SERVICE_OPTS,
+    return list(iter_images(conn, instrument=instrument_id))
+
+
+def iter_images(
+    conn,
+    instrument=None,
+    dataset=None,
+    project=None,
+    acquired_after=None,
+    acquired_before=None,
+    tags=None,
+    columns=None,
+    page_size=1000,
+    prefetch=1,
+):
+    """Yields the ids of the images matching all the given filters,
+    by increasing id, querying the database one page at a time.
+
+    Parameters
+    ----------
+    conn : a `BlitzGateway` connection
+    instrument : int, optional
+        only images acquired with this instrument
+    dataset : int, optional
+        only images in this dataset
+    project : int, optional
+        only images in a dataset of this project
+    acquired_after, acquired_before : datetime, ISO formated str or
+        milliseconds since the epoch, optional.
+        only images acquired at or after `acquired_after` and
+        strictly before `acquired_before`
+    tags : list of ints, optional
+        only images annotated with all those tags
+    columns : list of str, optional
+        keys of `IMAGE_COLUMNS` to retrieve along with the ids
+    page_size : int, default 1000
+        the number of rows retrieved per query
+    prefetch : int, default 1
+        number of pages queried ahead in a background thread
+        while the current one is consumed (0 to disable)
+
+    Yields
+    ------
+    image_id : int if `columns` is None
+    (image_id, *values) : tuple otherwise, with dates as `datetime` objects
+
+    Example
+    -------
+    .. code-block:: python
+        for image_id, name in iter_images(
+            conn, instrument=3, acquired_after="2020-01-01", columns=["name"]
+        ):
+            do_something
+
+    Note
+    ----
+    Pages are delimited by the last id of the previous page rather than
+    an offset, so that late pages are as cheap to query as the first ones.
+
+    """
+    columns = list(columns) if columns else []
+    unknown = set(columns) - set(IMAGE_COLUMNS)
+    if unknown:
+        raise ValueError(
+            f"Unknown columns {unknown}, choose among {list(IMAGE_COLUMNS)}"
+        )
+
+    params = ParametersI()
+    clauses = ["i.id > :last"]
+    if instrument is not None:
+        params.add("instrument", rlong(instrument))
+        clauses.append("i.instrument.id = :instrument")
+    if dataset is not None:
+        params.add("dataset", rlong(dataset))
+        clauses.append(
+            "exists (select l from DatasetImageLink l "
+            "where l.child = i and l.parent.id = :dataset)"
+        )
+    if project is not None:
+        params.add("project", rlong(project))
+        clauses.append(
+            "exists (select l from DatasetImageLink l, ProjectDatasetLink pl "
+            "where l.child = i and pl.child = l.parent and pl.parent.id = :project)"
+        )
+    if acquired_after is not None:
+        params.add("after", rtime(_to_millis(acquired_after)))
+        clauses.append("i.acquisitionDate >= :after")
+    if acquired_before is not None:
+        params.add("before", rtime(_to_millis(acquired_before)))
+        clauses.append("i.acquisitionDate < :before")
+    for k, tag in enumerate(tags or []):
+        params.add(f"tag{k}", rlong(tag))
+        clauses.append(
+            "exists (select al from ImageAnnotationLink al "
+            f"where al.parent = i and al.child.id = :tag{k})"
+        )
+
+    selected = ", ".join(["i.id"] + [IMAGE_COLUMNS[col][0] for col in columns])
+    joins = [IMAGE_COLUMNS[col][1] for col in columns]
+    joins = " ".join(dict.fromkeys(join for join in joins if join))
+    query = (
+        f"select {selected} from Image i {joins} "
+        f"where {' and '.join(clauses)} order by i.id"
     )
-    return [im[0].val for im in images]
+    is_date = [col in DATE_COLUMNS for col in columns]
+
+    conn.SERVICE_OPTS.setOmeroGroup("-1")
+    query_service = conn.getQueryService()
+
+    def pages():
+        last = -1
+        while True:
+            params.add("last", rlong(last))
+            params.page(0, page_size)
+            rows = [
+                unwrap(row)
+                for row in query_service.projection(query, params, conn.SERVICE_OPTS)
+            ]
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    for rows in background_iter(pages(), prefetch):
+        for row in rows:
+            if not columns:
+                yield row[0]
+                continue
+            values = tuple(
+                datetime.fromtimestamp(v / 1000) if date and v else v
+                for v, date in zip(row[1:], is_date)
+            )
+            yield (row[0],) + values
+
+
+def _to_millis(date):
+    """Converts a datetime, an ISO formated string or a timestamp in
+    milliseconds to milliseconds since the epoch
+    """
+    if isinstance(date, str):
+        date = datetime.fromisoformat(date)
+    if isinstance(date, datetime):
+        return int(date.timestamp() * 1000)
+    return int(date)
+
+
+def get_images_metadata(image_ids, conn, batch_size=1000):
+    """Returns the metadata of many images, as computed by
+    `OmeroImageReader.get_metadata`, with two projection queries
+    per `batch_size` images.
+
+    Parameters
+    ----------
+    image_ids : iterable of ints
+    conn : a `BlitzGateway` connection
+    batch_size : int, default 1000
+        the number of images per query
+
+    Returns
+    -------
+    metadata : dict
+        with the image ids as keys and the metadata dictionnaries as values.
+        Images not found in the database are absent from it.
+
+    Example
+    -------
+    .. code-block:: python
+        metadata = get_images_metadata(image_ids, conn)
+        table = pd.DataFrame.from_dict(metadata, orient="index")
+
+    """
+    conn.SERVICE_OPTS.setOmeroGroup("-1")
+    query_service = conn.getQueryService()
+    image_ids = [int(i) for i in image_ids]
+    metadata = {}
+    for start in range(0, len(image_ids), batch_size):
+        params = ParametersI()
+        params.addIds(image_ids[start : start + batch_size])
+        rows = query_service.projection(
+            "select i.id, i.acquisitionDate, "
+            "p.sizeX, p.sizeY, p.sizeZ, p.sizeC, p.sizeT, p.physicalSizeX.value, "
+            "obj.lensNA, obj.nominalMagnification "
+            "from Image i join i.pixels p "
+            "left outer join i.objectiveSettings os "
+            "left outer join os.objective obj "
+            "where i.id in (:ids)",
+            params,
+            conn.SERVICE_OPTS,
+        )
+        for row in rows:
+            (im_id, date, sx, sy, sz, sc, st, psx, na, mag) = unwrap(row)
+            metadata[im_id] = {
+                "SizeX": sx,
+                "SizeY": sy,
+                "SizeZ": sz,
+                "SizeC": sc,
+                "SizeT": st,
+                "Id": im_id,
+                "AquisitionDate": datetime.fromtimestamp(date / 1000)
+                if date
+                else None,
+                "PhysicalSizeX": psx,
+                "ChannelLabels": [],
+                "LensNA": np.nan if na is None else na,
+                "nominalMagnification": np.nan if mag is None else mag,
+            }
+
+        rows = query_service.projection(
+            "select p.image.id, index(ch), lc.name, lc.emissionWave.value "
+            "from Pixels p join p.channels ch join ch.logicalChannel lc "
+            "where p.image.id in (:ids) "
+            "order by p.image.id, index(ch)",
+            params,
+            conn.SERVICE_OPTS,
+        )
+        for row in rows:
+            im_id, index, name, emission = unwrap(row)
+            if im_id in metadata:
+                metadata[im_id]["ChannelLabels"].append(
+                    _channel_label(index, name, emission)
+                )
+    return metadata
+
+
+def _channel_label(index, name, emission):
+    """Same fallbacks as `omero.gateway.ChannelWrapper.getLabel`"""
+    if name is not None and name.strip():
+        return name
+    if emission is not None:
+        return f"{emission:g}"
+    return str(index)
+
+
+def get_pixels_ids(image_ids, conn, batch_size=1000):
+    """Returns a dictionnary with the image ids as keys and their
+    pixels ids as values, with one query per `batch_size` images
+    """
+    conn.SERVICE_OPTS.setOmeroGroup("-1")
+    query_service = conn.getQueryService()
+    image_ids = [int(i) for i in image_ids]
+    pixels_ids = {}
+    for start in range(0, len(image_ids), batch_size):
+        params = ParametersI()
+        params.addIds(image_ids[start : start + batch_size])
+        rows = query_service.projection(
+            "select p.image.id, p.id from Pixels p where p.image.id in (:ids)",
+            params,
+            conn.SERVICE_OPTS,
+        )
+        pixels_ids.update(unwrap(row) for row in rows)
+    return pixels_ids
+
+
+def get_thumbnails(image_ids, conn, size=128, store=None):
+    """Returns the thumbnails of many images with a single call
+    to the thumbnail store.
+
+    Parameters
+    ----------
+    image_ids : iterable of ints
+    conn : a `BlitzGateway` connection
+    size : int, default 128
+        the size of the longest side of the thumbnails
+    store : a thumbnail store, optional
+        as returned by `conn.createThumbnailStore()`, to reuse it
+        across calls. If not provided, a store is created and closed.
+
+    Returns
+    -------
+    thumbnails : dict
+        with the image ids as keys and the JPEG encoded thumbnails as values,
+        images without thumbnail are absent from it
+
+    """
+    pixels_ids = get_pixels_ids(image_ids, conn)
+    if not pixels_ids:
+        return {}
+    own_store = store is None
+    if own_store:
+        store = conn.createThumbnailStore()
+    try:
+        thumbs = store.getThumbnailByLongestSideSet(
+            rint(size), list(pixels_ids.values()), conn.SERVICE_OPTS
+        )
+    finally:
+        if own_store:
+            store.close()
+    return {
+        image_id: thumbs[pixels_id]
+        for image_id, pixels_id in pixels_ids.items()
+        if thumbs.get(pixels_id)
+    }
@@ -0,0 +1,221 @@
+"""Pool of OMERO connections sharing a single session
+
+"""
+import time
+import queue
+import threading
+from contextlib import contextmanager
+
+from omero.gateway import BlitzGateway
+
+
+class SessionPool:
+    """A pool of `BlitzGateway` connections all joined to the session
+    of a logged in connection, so that borrowing a connection never
+    costs a login.
+
+    Idle connections are kept alive in a background thread, and
+    connections found closed or expired when borrowed are transparently
+    reconnected. Borrowed connections are only used by their borrower.
+
+    Usage
+    -----
+    .. code-block:: python
+        pool = SessionPool(conn, size=4)
+        with pool.session() as conn:
+            image = conn.getObject("Image", image_id)
+
+        for image_id in image_ids:
+            with imageio.OmeroImageReader(image_id, pool=pool) as image_reader:
+                do_something
+        # the pooled connections are still open here
+        pool.close()
+
+    """
+
+    def __init__(self, conn, size=4, keepalive=60, factory=None):
+        """
+        Parameters
+        ----------
+        conn : a `BlitzGateway` connection
+            whose session is shared by the pool (will be connected at
+            instanciation). It is the first connection handed out by the
+            pool, and is not closed by `SessionPool.close`.
+        size : int, default 4
+            maximum number of connections in the pool
+        keepalive : float, default 60
+            interval in seconds between two keep alive calls on the idle
+            connections, set to 0 or None to disable. Connections idle for
+            longer are checked with a keep alive call when borrowed; when
+            disabled, they are only checked locally with `isConnected`
+        factory : callable, optional
+            function returning a new connected `BlitzGateway`, defaults
+            to joining `conn`'s session
+
+        """
+        if not conn.isConnected():
+            conn.connect()
+        self.conn = conn
+        self.size = size
+        self.keepalive = keepalive
+        self.factory = factory if factory is not None else self._join_session
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._connections = [conn]
+        self._creating = 0
+        self._last_used = {id(conn): time.monotonic()}
+        # ids of the borrowed connections, the keeper does not touch them
+        self._borrowed = set()
+        self._ping_lock = threading.Lock()
+        self._idle.put(conn)
+        self._closed = threading.Event()
+        if keepalive:
+            self._keeper = threading.Thread(target=self._keep_alive, daemon=True)
+            self._keeper.start()
+
+    @classmethod
+    def connect(cls, username, password, host="localhost", port=4064, **kwargs):
+        """Logs in the OMERO server and returns a pool sharing the session
+
+        Other keyword arguments are passed to the `SessionPool` constructor
+        """
+        conn = BlitzGateway(username, password, host=host, port=port)
+        return cls(conn, **kwargs)
+
+    def _join_session(self):
+        session_id = self.conn.getSession().getUuid().val
+        conn = BlitzGateway(host=self.conn.host, port=self.conn.port)
+        if not conn.connect(sUuid=session_id):
+            raise ConnectionError(f"Could not join session on {self.conn.host}")
+        return conn
+
+    def _reconnect(self, conn):
+        """Returns a working connection in place of `conn`"""
+        if conn is self.conn:
+            # logs in again if the shared session expired
+            conn.connect()
+            return conn
+        try:
+            return self.factory()
+        except Exception:
+            # the shared session is gone, start a new one
+            self.conn.connect()
+            return self.factory()
+
+    def _is_alive(self, conn):
+        try:
+            return conn.isConnected() and conn.keepAlive()
+        except Exception:
+            return False
+
+    def _keep_alive(self):
+        while not self._closed.wait(self.keepalive):
+            for conn in list(self._connections):
+                # a connection cannot be borrowed while it is pinged
+                with self._ping_lock:
+                    if id(conn) in self._borrowed:
+                        continue
+                    last_used = self._last_used.get(id(conn), 0)
+                    if time.monotonic() - last_used > self.keepalive:
+                        self._is_alive(conn)
+
+    def _create(self):
+        """Returns a new connection, or None if the pool is full"""
+        with self._lock:
+            if len(self._connections) + self._creating >= self.size:
+                return None
+            self._creating += 1
+        try:
+            conn = self.factory()
+        except Exception:
+            with self._lock:
+                self._creating -= 1
+            raise
+        with self._lock:
+            self._creating -= 1
+            self._connections.append(conn)
+            self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    def _wait(self, timeout):
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No connection available in the pool")
+
+    def acquire(self, timeout=None):
+        """Borrows a connection from the pool, waiting at most `timeout`
+        seconds for one to be available if the pool is full.
+
+        The connection must be given back with `SessionPool.release`.
+        """
+        if self._closed.is_set():
+            raise RuntimeError("The session pool is closed")
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._create() or self._wait(timeout)
+        with self._ping_lock:
+            self._borrowed.add(id(conn))
+
+        if self.keepalive:
+            idle_for = time.monotonic() - self._last_used.get(id(conn), 0)
+            stale = idle_for > self.keepalive and not self._is_alive(conn)
+        else:
+            stale = not conn.isConnected()
+        if stale:
+            try:
+                fresh = self._reconnect(conn)
+            except BaseException:
+                # gives the connection back, it is reconnected on next use
+                self._last_used[id(conn)] = 0
+                self._borrowed.discard(id(conn))
+                self._idle.put(conn)
+                raise
+            if fresh is not conn:
+                with self._lock:
+                    self._connections[self._connections.index(conn)] = fresh
+                    self._last_used.pop(id(conn), None)
+                with self._ping_lock:
+                    self._borrowed.discard(id(conn))
+                    self._borrowed.add(id(fresh))
+                try:
+                    conn.close(hard=False)
+                except Exception:
+                    pass
+                conn = fresh
+        return conn
+
+    def release(self, conn):
+        """Gives a connection borrowed with `SessionPool.acquire` back to the pool"""
+        self._last_used[id(conn)] = time.monotonic()
+        with self._ping_lock:
+            self._borrowed.discard(id(conn))
+        self._idle.put(conn)
+
+    @contextmanager
+    def session(self, timeout=None):
+        """Context manager borrowing a connection from the pool"""
+        conn = self.acquire(timeout=timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Closes all the pooled connections but the initial one,
+        leaving the shared session open
+        """
+        self._closed.set()
+        with self._lock:
+            for conn in self._connections:
+                if conn is not self.conn:
+                    # hard=False detaches without killing the shared session
+                    conn.close(hard=False)
+            self._connections = [self.conn]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
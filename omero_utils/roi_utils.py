@@ -1,14 +1,41 @@
 import io
 import base64
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-from skimage.draw import polygon2mask, polygon_perimeter
+from scipy import ndimage
+from skimage.draw import polygon, polygon2mask, polygon_perimeter, ellipse
+from skimage.measure import find_contours, approximate_polygon
+from PIL import Image
 import omero
-import imageio
-from omero.rtypes import rint, rstring
-
-
-def get_roi_thumb(conn, image, roi, z=None, t=None, c=None, draw_roi=True):
+from omero.rtypes import rint, rstring, unwrap
+
+from .pool import SessionPool
+from .imageio import (
+    PIXEL_TYPES,
+    open_raw_store,
+    get_resolution_levels,
+    pick_level,
+    read_level_tiles,
+    read_store_planes,
+)
+
+GEOMETRY_CACHE_SIZE = 100_000
+DEFAULT_COLORS = ["FF0000", "00FF00", "0000FF", "FF00FF", "00FFFF", "FFFF00"]
+"""Colors of the channels in `html_thumb`, as in the webclient"""
+MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+_geometry_cache = OrderedDict()
+_geometry_lock = threading.Lock()
+
+
+def get_roi_thumb(
+    conn, image, roi, z=None, t=None, c=None, draw_roi=True, size=None
+):
     """Returns a numpy array with the region around the roi image
 
     For now only shape ROIs are supported
@@ -25,93 +52,544 @@ def get_roi_thumb(conn, image, roi, z=None, t=None, c=None, draw_roi=True):
     c : int or list of ints
         the channel(s) (defaults to the first 3 colors)
     draw_roi : bool, default True
-        whether to draw the ROI shape
+        whether to draw the ROI shape. It is drawn with the maximum of
+        each channel in the thumbnail, so that it does not change their
+        intensity range, e.g. the default windows of `html_thumb`
+    size : int, optional
+        for pyramidal images, the thumbnail is read at the coarsest
+        resolution level where it is at least `size` pixels along its
+        longest side. Defaults to the full resolution.
+
+    Returns
+    -------
+    thumb : `np.ndarray` of shape (height, width, n_channels)
+
+    See Also
+    --------
+    `get_roi_thumbs` to get the thumbnails of many ROIs at once
+    """
+    return get_roi_thumbs(
+        conn, image, [roi], z=z, t=t, c=c, draw_roi=draw_roi, size=size
+    )[0]
+
+
+def get_roi_thumbs(
+    conn,
+    image,
+    rois,
+    z=None,
+    t=None,
+    c=None,
+    draw_roi=True,
+    cell_size=512,
+    whole_plane=0.5,
+    size=None,
+):
+    """Returns the thumbnails of many ROIs of an image, retrieving
+    the pixels through a single raw pixels store opened on `conn`.
+
+    ROIs are grouped by cells of `cell_size` pixels, and the region covering
+    each group is read as one tile per channel, unless the ROIs cover less
+    than a `whole_plane` fraction of it, in which case each ROI is read on
+    its own. If the ROIs cover more than a `whole_plane` fraction of the
+    image, the whole plane is read once instead.
+
+    Parameters
+    ----------
+    conn : a BlitzGateway connection to an omero database
+    image : an  `omero.gateway.ImageWrapper` object
+    rois : list or dict of omero ROIs
+    z, t, c, draw_roi :
+        see `get_roi_thumb`
+    cell_size : int, default 512
+        the size of the cells used to group nearby ROIs
+    whole_plane : float, default 0.5
+        above this fraction of the plane area covered by the ROIs
+        bounding boxes, the whole plane is read, and below this fraction
+        of the region covering a group, its ROIs are read one by one
+    size : int, optional
+        for pyramidal images, each thumbnail is read at the coarsest
+        resolution level where it is at least `size` pixels along its
+        longest side, e.g. the display size. Defaults to the full resolution.
+
+    Returns
+    -------
+    thumbs : dict
+        with the ROI indices (or keys if `rois` is a dict) as keys,
+        and the thumbnails as values, see `get_roi_thumb`
+
+    Example
+    -------
+    .. code-block:: python
+        rois = conn.getRoiService().findByImage(image.getId(), None).rois
+        thumbs = get_roi_thumbs(conn, image, rois)
+
     """
     if not conn.isConnected():
         conn.connect()
     pixels = image.getPrimaryPixels()
+    size_x, size_y = pixels.getSizeX(), pixels.getSizeY()
     if z is None:
         z = pixels.sizeZ // 2
     if t is None:
         t = pixels.sizeT // 2
-
-    roi = get_roi_as_arrays(roi)[0].astype(int)
-    x, y = (roi.min(axis=0).astype(int) - 1).clip(min=0)
-    width, height = (np.ptp(roi, axis=0) - 1).astype(int)
-
-    tile = x, y, width, height
     if c is None:
-        tiles = pixels.getTiles([(z, i, t, tile) for i in range(min(pixels.sizeC, 3))])
-    elif isinstance(c, list):
-        tiles = pixels.getTiles([(z, i, t, tile) for i in c])
+        channels = list(range(min(pixels.sizeC, 3)))
     elif isinstance(c, int):
-        tiles = pixels.getTile((z, c, t, tile))
+        channels = [c]
+    else:
+        channels = list(c)
+
+    items = rois.items() if isinstance(rois, dict) else enumerate(rois)
+    geometry = {}
+    for key, roi in items:
+        points = get_roi_as_arrays(roi)[0]
+        geometry[key] = points, _thumb_box(points, size_x, size_y)
+    if not geometry:
+        return {}
+
+    thumbs = {}
+
+    def cut(groups, planes):
+        for (rx, ry, _, _), keys in groups.items():
+            buffer = np.stack([next(planes) for _ in channels], axis=-1)
+            for key in keys:
+                points, (x, y, w, h) = geometry[key]
+                thumb = buffer[y - ry : y - ry + h, x - rx : x - rx + w].copy()
+                if draw_roi:
+                    shifted = np.round(points - [x, y]).astype(int)
+                    rr, cc = polygon_perimeter(
+                        shifted[:, 1], shifted[:, 0], shape=(h, w)
+                    )
+                    # not the pixel range maximum, which would darken
+                    # the rest of the thumbnail once windowed
+                    thumb[rr, cc] = thumb.max(axis=(0, 1))
+                thumbs[key] = thumb
+
+    levels = get_resolution_levels(conn, pixels.getId()) if size is not None else []
+    dtype = PIXEL_TYPES[pixels.getPixelsType().value]
+    # the pixels are read with `conn`, not the connection of `image`
+    store = open_raw_store(conn, pixels.getId())
+    try:
+        if len(levels) > 1:
+            _pyramid_thumbs(
+                store,
+                dtype,
+                geometry,
+                levels,
+                size,
+                (z, t, channels),
+                cell_size,
+                whole_plane,
+                cut,
+            )
+            return thumbs
+
+        # regions to read, and the ROIs cut from each of them
+        covered = sum(w * h for _, (_, _, w, h) in geometry.values())
+        if covered > whole_plane * size_x * size_y:
+            groups = {(0, 0, size_x, size_y): list(geometry)}
+            czts = [(ch, z, t) for ch in channels]
+            planes = read_store_planes(store, dtype, czts, size_x, size_y)
+        else:
+            boxes = {key: box for key, (_, box) in geometry.items()}
+            groups = _group_boxes(boxes, cell_size, whole_plane)
+            czt_tiles = [(ch, z, t, region) for region in groups for ch in channels]
+            planes = read_level_tiles(store, dtype, czt_tiles)
+        cut(groups, planes)
+    finally:
+        store.close()
+    return thumbs
+
+
+def _pyramid_thumbs(
+    store, dtype, geometry, levels, size, planes, cell_size, min_fill, cut
+):
+    """Reads the ROI thumbnails of `get_roi_thumbs` from the resolution
+    levels of a pyramidal image, converting `geometry` to each ROI level
+    """
+    (full_x, full_y) = levels[0]
+    by_level = {}
+    for key, (points, (_, _, w, h)) in geometry.items():
+        level = pick_level(levels, w, h, size)
+        level_x, level_y = levels[level]
+        points = points * [level_x / full_x, level_y / full_y]
+        geometry[key] = points, _thumb_box(points, level_x, level_y)
+        by_level.setdefault(level, []).append(key)
+
+    z, t, channels = planes
+    for level, keys in by_level.items():
+        boxes = {key: geometry[key][1] for key in keys}
+        groups = _group_boxes(boxes, cell_size, min_fill)
+        planes = read_level_tiles(
+            store,
+            dtype,
+            [(ch, z, t, region) for region in groups for ch in channels],
+            level,
+            len(levels),
+        )
+        cut(groups, planes)
 
-    thumb = (
-        np.concatenate(list(tiles))
-        .reshape((-1, height, width))
-        .swapaxes(0, -1)
-        .swapaxes(0, 1)
-    )
-    if draw_roi:
-        max_int = image.getPixelRange()[1]
-        shifted = (roi - np.array([x + 3, y + 3])[None, :]).clip(min=0)
-        coords = polygon_perimeter(shifted[:, 0], shifted[:, 1])
-        thumb[coords[1], coords[0]] = max_int
 
-    return thumb
+def _group_boxes(boxes, cell_size, min_fill=0):
+    """Groups (x, y, width, height) `boxes` by cells of `cell_size` pixels,
+    and returns a dictionnary with the region covering each group as keys
+    and the keys of the boxes in the group as values.
+
+    Groups whose boxes cover less than a `min_fill` fraction of their region
+    are split back into one region per box, so that sparse groups do not
+    cost more pixels than reading each box.
+    """
+    cells = {}
+    for key, (x, y, _, _) in boxes.items():
+        cells.setdefault((x // cell_size, y // cell_size), []).append(key)
+    groups = {}
+    for keys in cells.values():
+        cell_boxes = np.array([boxes[key] for key in keys])
+        x0, y0 = cell_boxes[:, :2].min(axis=0)
+        x1, y1 = (cell_boxes[:, :2] + cell_boxes[:, 2:]).max(axis=0)
+        covered = cell_boxes[:, 2:].prod(axis=1).sum()
+        if covered < min_fill * (x1 - x0) * (y1 - y0):
+            for key in keys:
+                groups.setdefault(tuple(boxes[key]), []).append(key)
+        else:
+            region = (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+            groups.setdefault(region, []).extend(keys)
+    return groups
+
+
+def _thumb_box(points, size_x, size_y, margin=1):
+    """Returns the (x, y, width, height) bounding box of `points`
+    with a `margin`, clipped to the image
+    """
+    x0, y0 = (np.floor(points.min(axis=0)).astype(int) - margin).clip(min=0)
+    x1, y1 = np.ceil(points.max(axis=0)).astype(int) + margin + 1
+    x1, y1 = min(x1, size_x), min(y1, size_y)
+    return int(x0), int(y0), int(x1 - x0), int(y1 - y0)
+
+
+def html_thumb(
+    thumb,
+    size=200,
+    windows=None,
+    colors=None,
+    fmt="jpeg",
+    quality=80,
+    compress_level=1,
+):
+    """Returns an HTML <img> tag with the thumbnail rendered and encoded
+    in its source.
+
+    The thumbnail is first downsampled to the display size, then each channel
+    is windowed to 8 bits and colored, and the resulting RGB (or grayscale
+    for a single white channel) image is encoded.
+
+    Parameters
+    ----------
+    thumb : `np.ndarray` of shape (height, width, n_channels) or (height, width)
+        as returned by `get_roi_thumb`
+    size : int, default 200
+        the display size of the longest side, in pixels
+    windows : list of (min, max) pairs, optional
+        the intensity window of each channel, defaults to the
+        minimum and maximum of each channel in the thumbnail
+    colors : list of str, optional
+        the hexadecimal RGB color of each channel, e.g. "FF0000", defaults
+        to white for a single channel and `DEFAULT_COLORS` otherwise
+    fmt : {"jpeg", "webp", "png"}, default "jpeg"
+        the encoding format
+    quality : int, default 80
+        the JPEG or WebP quality
+    compress_level : int, default 1
+        the PNG compression level, from 0 (fastest) to 9 (smallest)
 
+    Returns
+    -------
+    html : str
 
-def html_thumb(thumb):
-    """Returns an HTML
     """
+    rgb = render_thumb(thumb, size=size, windows=windows, colors=colors)
+    fmt = fmt.lower()
+    if fmt not in MIME_TYPES:
+        raise ValueError(f"Unknown format {fmt}, choose among {list(MIME_TYPES)}")
+    if fmt == "png":
+        options = {"compress_level": compress_level}
+    else:
+        options = {"quality": quality}
     with io.BytesIO() as out:
-        imageio.imwrite(out, thumb, format="PNG")
-        out.seek(0)
-        thumb = base64.b64encode(out.read()).decode("utf-8")
+        Image.fromarray(rgb).save(out, format=fmt.upper(), **options)
+        data = base64.b64encode(out.getvalue()).decode("ascii")
+
+    return (
+        f'<img style="width: {size}px; max-height: {size}px" '
+        f'src="data:{MIME_TYPES[fmt]};base64,{data}">'
+    )
+
+
+def render_thumb(thumb, size=200, windows=None, colors=None):
+    """Returns the thumbnail downsampled so that its longest side is at most
+    `size` and rendered as an uint8 RGB (or grayscale) image.
+
+    See `html_thumb` for the parameters
+    """
+    thumb = np.asarray(thumb)
+    if thumb.ndim == 2:
+        thumb = thumb[..., np.newaxis]
+    thumb = downsample(thumb, size)
+    n_channels = thumb.shape[-1]
+    if colors is None:
+        colors = ["FFFFFF"] if n_channels == 1 else DEFAULT_COLORS
+    if windows is None:
+        windows = [
+            (thumb[..., ch].min(), thumb[..., ch].max()) for ch in range(n_channels)
+        ]
+
+    if n_channels == 1 and colors[0].upper() == "FFFFFF":
+        return window(thumb[..., 0], *windows[0])
+
+    rgb = np.zeros(thumb.shape[:2] + (3,), dtype=np.uint16)
+    for ch in range(n_channels):
+        color = np.array(_hex_to_rgb(colors[ch % len(colors)]), dtype=np.uint16)
+        rgb += window(thumb[..., ch], *windows[ch])[..., np.newaxis] * color // 255
+    return np.minimum(rgb, 255).astype(np.uint8)
+
+
+def downsample(thumb, size):
+    """Averages blocks of pixels of `thumb` so that its longest side
+    is at most `size`, the first two axes being y and x.
+    The data type is preserved.
+    """
+    factor = -(-max(thumb.shape[:2]) // size)
+    if factor <= 1:
+        return thumb
+    h, w = (thumb.shape[0] // factor) * factor, (thumb.shape[1] // factor) * factor
+    if not h or not w:
+        return thumb[::factor, ::factor]
+    blocks = thumb[:h, :w].reshape(
+        (h // factor, factor, w // factor, factor) + thumb.shape[2:]
+    )
+    mean = blocks.mean(axis=(1, 3), dtype=np.float32)
+    if thumb.dtype.kind in "uib":
+        return np.rint(mean, out=mean).astype(thumb.dtype)
+    return mean
 
-    return f"""<img style="width: 200px; max-height: 200px" src="data:image/png;base64,{thumb}">"""
 
+def window(channel, vmin, vmax):
+    """Maps the intensities of `channel` between `vmin` and `vmax`
+    linearly to 0 - 255, clipping outside values, as an uint8 array.
 
-def get_rois_as_labels(image, conn):
+    8 and 16 bits integer channels go through a cached lookup table.
     """
+    channel = np.asarray(channel)
+    if channel.dtype.kind in "ui" and channel.dtype.itemsize <= 2:
+        lut = _window_lut(channel.dtype.str, float(vmin), float(vmax))
+        if channel.dtype.kind == "i":
+            # the table starts at the dtype minimum
+            channel = channel.astype(np.int32) - np.iinfo(channel.dtype).min
+        return lut[channel]
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    out = (channel.astype(np.float32) - vmin) * scale
+    return np.clip(out, 0, 255, out=out).astype(np.uint8)
+
+
+@lru_cache(maxsize=64)
+def _window_lut(dtype, vmin, vmax):
+    """Lookup table windowing all the values of the integer `dtype`"""
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=np.float32)
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    lut = np.clip((values - vmin) * scale, 0, 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def _hex_to_rgb(color):
+    color = color.lstrip("#")
+    return tuple(int(color[i : i + 2], 16) for i in (0, 2, 4))
+
+
+def get_rois_as_labels(image, conn, z=None, t=None, dtype=None, overlap="last"):
+    """Rasterizes the image ROIs in a label image, where the pixels inside
+    the shapes of the i-th ROI are set to i + 1, and the background to 0.
+
+    Each shape is only rasterized over its bounding box. Polygon, rectangle,
+    ellipse, point and mask shapes are supported, other shapes are ignored,
+    as are shapes transforms.
+
     Parameters
     ----------
     image : omero `Image` obect
     conn : connection to the omero DB
+    z, t : ints, optional
+        if given, only the shapes on this Z plane (resp. time point) are
+        rasterized, as well as the shapes not bound to a Z plane (resp. time point)
+    dtype : numpy integer dtype, optional
+        the labels dtype, defaults to uint16, or uint32 if there are more than
+        65535 ROIs
+    overlap : {"last", "first"}, default "last"
+        where shapes overlap, whether the label of the last or first
+        rasterized ROI is kept
 
     Returns
     -------
-    labels : `np.ndarray` with the image shape
+    labels : `np.ndarray` with the image plane shape (SizeY, SizeX)
 
     """
+    if overlap not in ("last", "first"):
+        raise ValueError(f"overlap should be 'last' or 'first', not {overlap!r}")
 
-    imshape = (image.getSizeX(), image.getSizeY())
+    imshape = (image.getSizeY(), image.getSizeX())
 
     roi_service = conn.getRoiService()
     rois = roi_service.findByImage(image.getId(), None, conn.SERVICE_OPTS).rois
-    labels = np.zeros(imshape)
+    if dtype is None:
+        dtype = np.uint16 if len(rois) < 2 ** 16 else np.uint32
+    labels = np.zeros(imshape, dtype=dtype)
     for i, roi in enumerate(rois):
         for u in range(roi.sizeOfShapes()):
             shape = roi.getShape(u)
-            labels += mask_from_polyon_shape(shape, imshape) * (i + 1)
+            if not _in_plane(shape, z, t):
+                continue
+            index = shape_pixels(shape, imshape)
+            if index is None:
+                continue
+            if overlap == "last":
+                labels[index] = i + 1
+            else:
+                current = labels[index]
+                labels[index] = np.where(current == 0, i + 1, current)
 
     return labels
 
 
-def get_roi_as_arrays(roi):
-    roi_arrays = []
-    for u in range(roi.sizeOfShapes()):
-        shape = roi.getShape(u)
-        roi_arrays.append(
-            np.array(
-                [
-                    [float(v) for v in l.split(",") if v]
-                    for l in shape.getPoints().val.split(" ")
-                ]
-            )
+def _in_plane(shape, z, t):
+    the_z, the_t = unwrap(shape.getTheZ()), unwrap(shape.getTheT())
+    return (z is None or the_z is None or the_z == z) and (
+        t is None or the_t is None or the_t == t
+    )
+
+
+def shape_pixels(shape, imshape):
+    """Returns the index of the pixels inside an omero `shape`, clipped
+    to an image of shape `imshape`, such that `image[index]` are the
+    pixels values inside the shape.
+
+    Only the shape bounding box is visited. Returns None for unsupported
+    shape types (lines, polylines, labels).
+    """
+    height, width = imshape
+    if isinstance(shape, omero.model.PolygonI):
+        points = get_shape_points(shape)
+        if not points.size:
+            return None
+        x0, y0 = np.floor(points.min(axis=0)).astype(int).clip(min=0)
+        x1, y1 = np.ceil(points.max(axis=0)).astype(int) + 1
+        x1, y1 = min(x1, width), min(y1, height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        rr, cc = polygon(
+            points[:, 1] - y0, points[:, 0] - x0, shape=(y1 - y0, x1 - x0)
+        )
+        return rr + y0, cc + x0
+
+    if isinstance(shape, omero.model.RectangleI):
+        x, y = unwrap(shape.getX()), unwrap(shape.getY())
+        w, h = unwrap(shape.getWidth()), unwrap(shape.getHeight())
+        x0, y0 = max(int(round(x)), 0), max(int(round(y)), 0)
+        x1, y1 = min(int(round(x + w)), width), min(int(round(y + h)), height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return slice(y0, y1), slice(x0, x1)
+
+    if isinstance(shape, omero.model.EllipseI):
+        rr, cc = ellipse(
+            unwrap(shape.getY()),
+            unwrap(shape.getX()),
+            unwrap(shape.getRadiusY()),
+            unwrap(shape.getRadiusX()),
+            shape=imshape,
         )
-    return roi_arrays
+        return rr, cc
+
+    if isinstance(shape, omero.model.PointI):
+        x, y = int(round(unwrap(shape.getX()))), int(round(unwrap(shape.getY())))
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+        return np.array([y]), np.array([x])
+
+    if isinstance(shape, omero.model.MaskI):
+        x, y = int(round(unwrap(shape.getX()))), int(round(unwrap(shape.getY())))
+        w = int(round(unwrap(shape.getWidth())))
+        h = int(round(unwrap(shape.getHeight())))
+        bits = np.unpackbits(np.frombuffer(shape.getBytes(), dtype=np.uint8))
+        rr, cc = np.nonzero(bits[: w * h].reshape(h, w))
+        rr, cc = rr + y, cc + x
+        inside = (rr >= 0) & (rr < height) & (cc >= 0) & (cc < width)
+        return rr[inside], cc[inside]
+
+    return None
+
+
+def get_roi_as_arrays(roi):
+    """Returns a list with the (N, 2) array of (x, y) points
+    of each shape of `roi`, see `get_shape_points`
+    """
+    return [get_shape_points(roi.getShape(u)) for u in range(roi.sizeOfShapes())]
+
+
+def parse_points(points):
+    """Converts an omero `points` string to a (N, 2) array of (x, y) floats
+
+    Parameters
+    ----------
+    points : str or `omero.rtypes.RStringI`
+        the points, formated either as "x1,y1 x2,y2 ...", "x1,y1, x2,y2, ..."
+        or in the legacy "points[x1,y1 x2,y2 ...] points1[...] ..." format,
+        in which case only the first list is read
+
+    Returns
+    -------
+    points : `np.ndarray` of shape (N, 2)
+
+    """
+    points = unwrap(points)
+    start = points.find("[")
+    if start >= 0:
+        points = points[start + 1 : points.index("]", start)]
+    values = np.array(points.replace(",", " ").split(), dtype=float)
+    if values.size % 2:
+        raise ValueError("Odd number of coordinates in points string")
+    return values.reshape(-1, 2)
+
+
+def get_shape_points(shape):
+    """Returns the points of a polygon or polyline `shape` as a read-only
+    (N, 2) array of (x, y) floats.
+
+    Parsed points are cached by points string, so that the same points are
+    parsed only once per session, whatever the server the shape comes
+    from and whether it is saved or not.
+    """
+    key = unwrap(shape.getPoints())
+    with _geometry_lock:
+        points = _geometry_cache.get(key)
+        if points is not None:
+            _geometry_cache.move_to_end(key)
+            return points
+
+    points = parse_points(key)
+    points.flags.writeable = False
+    with _geometry_lock:
+        _geometry_cache[key] = points
+        while len(_geometry_cache) > GEOMETRY_CACHE_SIZE:
+            _geometry_cache.popitem(last=False)
+    return points
+
+
+def clear_geometry_cache():
+    """Empties the cache of parsed shape points"""
+    with _geometry_lock:
+        _geometry_cache.clear()
 
 
 def mask_from_polyon_shape(shape, imshape):
@@ -129,13 +607,7 @@ def mask_from_polyon_shape(shape, imshape):
        input shape.
 
     """
-
-    points = shape.getPoints()
-
-    points = np.array(
-        [[float(v) for v in l.split(",") if v] for l in points.val.split(" ")]
-    )
-    return polygon2mask(imshape, points).astype(np.uint8)
+    return polygon2mask(imshape, get_shape_points(shape)).astype(np.uint8)
 
 
 def polygon_to_shape(polygon, z=0, t=0, c=0):
@@ -155,10 +627,71 @@ def polygon_to_shape(polygon, z=0, t=0, c=0):
     shape.theZ = rint(z)
     shape.theT = rint(t)
     shape.theC = rint(c)
-    shape.points = rstring(", ".join((f"{int(p[0])},{int(p[1])}" for p in polygon)))
+    points = np.asarray(polygon).astype(int).tolist()
+    shape.points = rstring(" ".join(f"{x},{y}" for x, y in points))
     return shape
 
 
+def labels_to_polygons(labels, tolerance=None):
+    """Extracts the outer contour of each label of a label image as a polygon.
+
+    The bounding boxes of all labels are found in a single pass over the
+    image, and each contour is then traced only inside its label's box.
+
+    Parameters
+    ----------
+    labels : `np.ndarray` of non negative ints with shape (height, width)
+        e.g. the output of StarDist `predict_instances`, 0 is the background
+    tolerance : float, optional
+        if given, each contour is simplified so that no point of the
+        original contour is further than `tolerance` pixels from the
+        simplified one, which shortens the points strings stored in OMERO
+
+    Returns
+    -------
+    polygons : dict
+        with the labels as keys and (N, 2) arrays of (x, y) points as values,
+        the contour is not closed (the last point differs from the first one)
+
+    """
+    polygons = {}
+    for i, region in enumerate(ndimage.find_objects(labels)):
+        if region is None:
+            continue
+        label = i + 1
+        mask = np.pad(labels[region] == label, 1).astype(np.float32)
+        contours = find_contours(mask, 0.5)
+        if not contours:
+            continue
+        contour = max(contours, key=len)
+        if tolerance:
+            contour = approximate_polygon(contour, tolerance)
+        if len(contour) > 1 and (contour[0] == contour[-1]).all():
+            contour = contour[:-1]
+        # undo the padding
+        y0, x0 = region[0].start - 1, region[1].start - 1
+        polygons[label] = np.column_stack((contour[:, 1] + x0, contour[:, 0] + y0))
+    return polygons
+
+
+def register_labels(image, labels, conn, z=0, t=0, c=0, tolerance=1.0, **kwargs):
+    """Creates one ROI per label of a label image, see `labels_to_polygons`
+    and `register_polygons`.
+
+    Other keyword arguments are passed to `register_polygons`
+
+    Returns
+    -------
+    roi_ids : dict with the labels as keys and the created ROI ids as values
+
+    """
+    polygons = labels_to_polygons(labels, tolerance=tolerance)
+    roi_ids = register_polygons(
+        image, list(polygons.values()), conn, z=z, t=t, c=c, **kwargs
+    )
+    return dict(zip(polygons, roi_ids))
+
+
 def register_shape_to_roi(image, polygon, conn, roi=None, z=0, t=0, c=0):
     """Adds a polygon shape to an omero ROI. If no roi is provided,
     creates it first.
@@ -190,3 +723,71 @@ def register_shape_to_roi(image, polygon, conn, roi=None, z=0, t=0, c=0):
     roi.addShape(shape)
     # Save the ROI (saves any linked shapes too)
     return updateService.saveAndReturnObject(roi)
+
+
+def register_polygons(
+    image, polygons, conn, z=0, t=0, c=0, chunk_size=500, workers=4
+):
+    """Creates one ROI per polygon and saves them by chunks, with a
+    single server call per chunk.
+
+    Parameters
+    ----------
+    image : omero Image object or image id
+    polygons : sequence of np.ndarrays of shape (N, 2)
+        the (x, y) points of each polygon
+    conn : connection to the omero db, or `omero_utils.pool.SessionPool`
+        if a pool is passed, the chunks are saved in parallel by
+        `workers` threads, each using a pooled connection
+    z, t, c : ints or sequences of ints, default 0
+        position of the polygons in the stack, either common to all
+        polygons or one per polygon
+    chunk_size : int, default 500
+        number of ROIs saved per call
+    workers : int, default 4
+        number of chunks saved at once when `conn` is a pool
+
+    Returns
+    -------
+    roi_ids : list of ints, the ids of the created ROIs, in the order
+        of `polygons`
+
+    Example
+    -------
+    .. code-block:: python
+        labels, details = model.predict_instances(img)
+        polygons = [coords[::-1].T for coords in details["coord"]]
+        roi_ids = register_polygons(image, polygons, conn, z=12)
+
+    """
+    n_polygons = len(polygons)
+    zs, ts, cs = (np.broadcast_to(v, (n_polygons,)) for v in (z, t, c))
+    image_id = image if isinstance(image, (int, np.integer)) else image.getId()
+    # an unloaded image is enough to link the ROIs, no need to send it over
+    image_obj = omero.model.ImageI(unwrap(image_id), False)
+
+    def save(start, conn):
+        rois = []
+        for i in range(start, min(start + chunk_size, n_polygons)):
+            roi = omero.model.RoiI()
+            roi.setImage(image_obj)
+            roi.addShape(
+                polygon_to_shape(polygons[i], z=int(zs[i]), t=int(ts[i]), c=int(cs[i]))
+            )
+            rois.append(roi)
+        return conn.getUpdateService().saveAndReturnIds(rois)
+
+    starts = range(0, n_polygons, chunk_size)
+    if isinstance(conn, SessionPool):
+        pool = conn
+
+        def save_pooled(start):
+            with pool.session() as conn:
+                return save(start, conn)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(save_pooled, starts))
+    else:
+        chunks = [save(start, conn) for start in starts]
+
+    return [roi_id for chunk in chunks for roi_id in chunk]
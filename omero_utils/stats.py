@@ -0,0 +1,422 @@
+"""Instrumentation of the calls to the OMERO server
+
+Calls are recorded through proxies of the gateway, its services, and the
+image and pixels wrappers, see `instrument`. Each `CallStats` object keeps,
+per remote operation, the number of calls and errors, the bytes transfered
+and a histogram of the latencies. Pixel data and thumbnails are counted
+exactly, ROIs from the size of their shapes points, see `roi_nbytes`, and
+the other payloads (metadata, query results...) are not counted.
+
+Readers and widgets record their calls in their own `stats` attribute,
+which also forwards them to the process wide `STATS`.
+
+Usage
+-----
+.. code-block:: python
+    with OmeroImageReader(image_id, conn) as reader:
+        stack = reader.as_array()[...]
+    print(reader.stats)
+
+    # functions taking a connection record their calls through a proxy
+    conn = instrument(conn)
+    labels = get_rois_as_labels(image, conn)
+    print(STATS)
+
+    # dumps the process wide statistics every minute
+    reporter = StatsReporter(STATS, interval=60, path="omero_stats.json")
+    ...
+    reporter.stop()
+
+"""
+import json
+import time
+import inspect
+import threading
+
+import numpy as np
+
+
+N_BUCKETS = 32
+"""Number of latency buckets, the i-th one counts the calls that
+took less than 2 ** i µs (the last one counts all the longer calls)
+"""
+
+
+class CallStats:
+    """Per operation counters, byte totals and latency histograms
+    of remote calls
+
+    Attributes
+    ----------
+    name : str, used in reports
+    parent : `CallStats`, optional
+        where the calls are also recorded, e.g. `STATS`
+
+    """
+
+    def __init__(self, name="", parent=None):
+        self.name = name
+        self.parent = parent
+        self._lock = threading.Lock()
+        self._ops = {}
+
+    def record(self, op, seconds, nbytes=0, error=False):
+        """Records a call to `op` that took `seconds` and transfered `nbytes`"""
+        bucket = min(int(seconds * 1e6).bit_length(), N_BUCKETS - 1)
+        with self._lock:
+            counters = self._ops.get(op)
+            if counters is None:
+                counters = self._ops[op] = _OpCounters()
+            counters.count += 1
+            counters.errors += error
+            counters.nbytes += nbytes
+            counters.seconds += seconds
+            counters.max_seconds = max(counters.max_seconds, seconds)
+            counters.histogram[bucket] += 1
+        if self.parent is not None:
+            self.parent.record(op, seconds, nbytes, error)
+
+    def quantile(self, op, q):
+        """Returns an upper bound of the `q` quantile of the latency
+        of `op`, in seconds, from its histogram
+        """
+        with self._lock:
+            counters = self._ops[op]
+            histogram = counters.histogram.copy()
+            max_seconds = counters.max_seconds
+        cumulated = np.cumsum(histogram)
+        bucket = int(np.searchsorted(cumulated, q * cumulated[-1]))
+        return min(2 ** bucket * 1e-6, max_seconds)
+
+    def summary(self):
+        """Returns a dictionnary with the operations as keys and
+        dictionnaries of their counters as values, times in seconds
+        """
+        with self._lock:
+            ops = list(self._ops)
+        summary = {}
+        for op in ops:
+            with self._lock:
+                counters = self._ops[op]
+                summary[op] = {
+                    "count": counters.count,
+                    "errors": counters.errors,
+                    "nbytes": counters.nbytes,
+                    "total": counters.seconds,
+                    "mean": counters.seconds / counters.count,
+                    "max": counters.max_seconds,
+                }
+            for q in (50, 90, 99):
+                summary[op][f"p{q}"] = self.quantile(op, q / 100)
+        return summary
+
+    def histograms(self):
+        """Returns the latency histograms, see `N_BUCKETS`"""
+        with self._lock:
+            return {op: c.histogram.tolist() for op, c in self._ops.items()}
+
+    @property
+    def count(self):
+        """Total number of recorded calls"""
+        with self._lock:
+            return sum(c.count for c in self._ops.values())
+
+    @property
+    def nbytes(self):
+        """Total number of bytes transfered"""
+        with self._lock:
+            return sum(c.nbytes for c in self._ops.values())
+
+    def reset(self):
+        """Forgets all the recorded calls"""
+        with self._lock:
+            self._ops.clear()
+
+    def to_json(self, path=None):
+        """Returns the summary and histograms as a JSON string,
+        and writes it to `path` if given
+        """
+        dump = json.dumps(
+            {
+                "name": self.name,
+                "time": time.time(),
+                "operations": self.summary(),
+                "histograms": self.histograms(),
+            },
+            indent=2,
+        )
+        if path is not None:
+            with open(path, "w") as fh:
+                fh.write(dump)
+        return dump
+
+    def __str__(self):
+        lines = [
+            f"{self.name or 'calls':<28} {'count':>7} {'errors':>6} {'MiB':>9} "
+            f"{'total s':>9} {'mean ms':>9} {'p90 ms':>9} {'max ms':>9}"
+        ]
+        for op, s in sorted(self.summary().items(), key=lambda i: -i[1]["total"]):
+            lines.append(
+                f"{op:<28} {s['count']:>7d} {s['errors']:>6d} "
+                f"{s['nbytes'] / 2**20:>9.2f} {s['total']:>9.3f} "
+                f"{1e3 * s['mean']:>9.2f} {1e3 * s['p90']:>9.2f} {1e3 * s['max']:>9.2f}"
+            )
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return f"<CallStats {self.name!r}: {self.count} calls>"
+
+
+class _OpCounters:
+    __slots__ = ("count", "errors", "nbytes", "seconds", "max_seconds", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = np.zeros(N_BUCKETS, dtype=np.int64)
+
+
+STATS = CallStats("process")
+"""The process wide statistics"""
+
+
+class StatsReporter:
+    """Prints or writes as JSON a `CallStats` every `interval` seconds,
+    in a background thread, until `stop` is called.
+    """
+
+    def __init__(self, stats=None, interval=60, path=None):
+        """
+        Parameters
+        ----------
+        stats : `CallStats`, default `STATS`
+        interval : float, default 60
+            seconds between two reports
+        path : str, optional
+            if given, the JSON report is written (and overwritten) in
+            this file, else the stats table is printed
+
+        """
+        self.stats = stats if stats is not None else STATS
+        self.interval = interval
+        self.path = path
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def report(self):
+        if self.path is None:
+            print(self.stats)
+        else:
+            self.stats.to_json(self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        """Stops the reports, after a last one"""
+        self._stopped.set()
+        self._thread.join()
+        self.report()
+
+
+# Remote methods of the proxied objects, and the proxies of their results
+_SERVICE = "service"
+_RULES = {
+    "gateway": {
+        "remote": {
+            "connect",
+            "keepAlive",
+            "getObject",
+            "getObjects",
+            "createThumbnailStore",
+            "createRawPixelsStore",
+        },
+        "results": {"getObject": "image", "getObjects": "image"},
+    },
+    "image": {
+        "remote": {
+            "getThumbnail",
+            "getChannelLabels",
+            "getChannels",
+            "getPixelRange",
+            "getObjectiveSettings",
+            "getROICount",
+        },
+        "results": {"getPrimaryPixels": "pixels"},
+    },
+    "pixels": {
+        "remote": {"getPlane", "getPlanes", "getTile", "getTiles", "getHistogram"},
+        "results": {},
+    },
+}
+
+
+def instrument(obj, stats=None, kind="gateway"):
+    """Returns a proxy of `obj` recording its remote calls in `stats`
+
+    Parameters
+    ----------
+    obj : a `BlitzGateway` connection, or an image or pixels wrapper
+    stats : `CallStats`, default `STATS`
+    kind : {"gateway", "image", "pixels", "service"}, default "gateway"
+        the type of `obj`
+
+    Returns
+    -------
+    proxy : an object behaving like `obj`. Services retrieved from a
+        gateway proxy (`getRoiService`, `createThumbnailStore`...),
+        and images and pixels retrieved from them are proxied as well.
+
+    """
+    if stats is None:
+        stats = STATS
+    if isinstance(obj, _Proxy):
+        obj = obj._target
+    return _Proxy(obj, stats, kind)
+
+
+def uninstrument(obj):
+    """Returns the object proxied by `obj`, or `obj` if it is not a proxy"""
+    return obj._target if isinstance(obj, _Proxy) else obj
+
+
+def get_stats(obj):
+    """Returns the `CallStats` where the proxy `obj` records its calls,
+    or None if it is not a proxy
+    """
+    return obj._stats if isinstance(obj, _Proxy) else None
+
+
+class _Proxy:
+
+    __slots__ = ("_target", "_stats", "_kind")
+
+    def __init__(self, target, stats, kind):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_stats", stats)
+        object.__setattr__(self, "_kind", kind)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        if self._kind == _SERVICE:
+            remote, result_kind = True, None
+        else:
+            rules = _RULES[self._kind]
+            remote = name in rules["remote"]
+            result_kind = rules["results"].get(name)
+            if self._kind == "gateway" and (
+                (name.startswith("get") and name.endswith("Service"))
+                or (name.startswith("create") and name.endswith("Store"))
+            ):
+                result_kind = _SERVICE
+        if not remote and result_kind is None:
+            return attr
+        return _wrap_method(attr, name, self._stats, remote, result_kind)
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __repr__(self):
+        return f"<instrumented {self._target!r}>"
+
+
+def _wrap_method(method, op, stats, remote, result_kind):
+    def wrapped(*args, **kwargs):
+        if not remote:
+            return _proxy_result(method(*args, **kwargs), stats, result_kind)
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            stats.record(op, time.perf_counter() - start, error=True)
+            raise
+        if inspect.isgenerator(result):
+            return _record_items(result, op, stats, start, result_kind)
+        # ROIs sent to the update service count as well
+        sent = sum(_nbytes(arg) for arg in args)
+        stats.record(op, time.perf_counter() - start, sent + _nbytes(result))
+        return _proxy_result(result, stats, result_kind)
+
+    wrapped.__name__ = op
+    wrapped.__doc__ = method.__doc__
+    return wrapped
+
+
+def _record_items(generator, op, stats, start, result_kind):
+    """Records a generator of remote results as a single call once it is
+    exhausted or closed: the time spent producing its items, including
+    the time spent to call the generator, and their total size
+    """
+    seconds = nbytes = 0
+    error = False
+    try:
+        while True:
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except Exception:
+                error = True
+                raise
+            finally:
+                seconds += time.perf_counter() - start
+            nbytes += _nbytes(item)
+            yield _proxy_result(item, stats, result_kind)
+            start = time.perf_counter()
+    finally:
+        # closing early also closes the remote query
+        generator.close()
+        stats.record(op, seconds, nbytes, error=error)
+
+
+def _proxy_result(result, stats, kind):
+    if kind is None or result is None:
+        return result
+    if inspect.isgenerator(result):
+        return (_Proxy(item, stats, kind) for item in result)
+    return _Proxy(result, stats, kind)
+
+
+def _nbytes(result):
+    """Size of the binary payload of a remote call result, or estimated
+    size of the ROIs it holds, 0 if it has none
+    """
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    if isinstance(result, dict):
+        return sum(len(v) for v in result.values() if isinstance(v, (bytes, bytearray)))
+    if isinstance(result, (list, tuple)):
+        return sum(_nbytes(item) for item in result)
+    try:
+        if hasattr(result, "sizeOfShapes"):
+            return roi_nbytes(result)
+        # omero.api.RoiResult, from the ROI service
+        rois = getattr(result, "rois", None)
+        if isinstance(rois, (list, tuple)):
+            return sum(roi_nbytes(roi) for roi in rois)
+    except Exception:
+        # e.g. unloaded model objects, counted as nothing
+        pass
+    return 0
+
+
+def roi_nbytes(roi):
+    """Rough size of a serialized `omero.model.Roi`: a fixed overhead
+    per object and the length of the shapes points strings
+    """
+    nbytes = 64
+    for u in range(roi.sizeOfShapes()):
+        shape = roi.getShape(u)
+        points = shape.getPoints() if hasattr(shape, "getPoints") else None
+        nbytes += 64 + len(getattr(points, "val", None) or "")
+    return nbytes
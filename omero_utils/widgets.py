@@ -2,12 +2,17 @@
 
 """
 import base64
+import asyncio
+import threading
 from time import sleep
+from itertools import islice
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import ipywidgets as widgets
 from IPython.display import display, Image
 import omero
 from omero.gateway import BlitzGateway
-from omero.rtypes import rint
 import pandas as pd
 from bqplot import (
     Figure,
@@ -21,7 +26,15 @@ from bqplot import (
     DateColorScale,
 )
 
-from .roi_utils import get_roi_thumb, html_thumb
+from .roi_utils import get_roi_thumb, get_roi_thumbs, html_thumb
+from .pool import SessionPool
+from .cache import ThumbCache
+from .images import get_thumbnails
+from .imageio import chunked
+from .stats import CallStats, STATS, instrument, uninstrument
+
+
+LOADING = "<p>Loading thumbnail...</p>"
 
 
 class OMEConnect(widgets.VBox):
@@ -80,13 +93,29 @@ class ThumbScatterViz(widgets.VBox):
         mouseover=False,
         host="localhost",
         port=4090,
+        thumb_cache=None,
+        max_points=50_000,
     ):
         """Interactive scatter plot visualisation - this is a base class,
         use either `ROIScatterViz` for one image with multiple ROIs
         or `ImageScatterViz` for a scatterplot with multiple images
+
+        Thumbnails are kept in `thumb_cache`, a `omero_utils.cache.ThumbCache`,
+        which can be shared between widgets and backed by an on disk store
+        to persist across sessions. Defaults to a 64 MiB in memory cache.
+
+        At most `max_points` points are sent to the plot. For larger tables,
+        a deterministic subsample of the points in the current view is shown,
+        refined to the actual points as the view is zoomed in. The subsample
+        is stable: points shown at a zoom level stay shown when zooming in.
         """
         self.port = port
+        self.mouseover = mouseover
+        self.max_points = max_points
         self.measures = measures
+        # display priority of each row, the lowest are shown first
+        self._priority = np.random.RandomState(0).permutation(len(measures))
+        self._view_timer = None
         self.columns = list(measures.columns)
         x_col = x if x else self.columns[0]
         y_col = y if y else self.columns[1]
@@ -117,29 +146,24 @@ class ThumbScatterViz(widgets.VBox):
         )
 
         self.sheet = widgets.Output()
-        self.thumbs = {}
+        self.thumbs = thumb_cache if thumb_cache is not None else ThumbCache()
+        self.pool = None
+        # server calls of the widget, see `omero_utils.stats`
+        self.stats = CallStats(type(self).__name__, parent=STATS)
         self.goto = widgets.HTML("")
-        if is_datetime(self.measures, x_col):
-            x_sc = DateScale()
-        else:
-            x_sc = LinearScale()
-
-        if is_datetime(self.measures, y_col):
-            y_sc = DateScale()
-        else:
-            y_sc = LinearScale()
-
-        if is_datetime(self.measures, c_col):
-            c_sc = DateColorScale(scheme="viridis")
-        else:
-            c_sc = ColorScale()
+        # per column arrays as sent to the plot
+        self._arrays = {}
+        x_sc = self._new_scale("x", x_col)
+        y_sc = self._new_scale("y", y_col)
+        c_sc = self._new_scale("color", c_col)
 
+        self.rows = self.view_rows(x_sc, y_sc)
         self.scat = Scatter(
-            x=self.measures[self.x_selecta.value],
-            y=self.measures[self.y_selecta.value],
-            color=self.measures[self.c_selecta.value],
+            x=self.shown_array(x_col),
+            y=self.shown_array(y_col),
+            color=self.shown_array(c_col),
             scales={"x": x_sc, "y": y_sc, "color": c_sc,},
-            names=self.measures.index,
+            names=self.measures.index[self.rows],
             display_names=False,
             fill=True,
             default_opacities=[0.8,],
@@ -155,12 +179,18 @@ class ThumbScatterViz(widgets.VBox):
         self.fig = Figure(marks=[self.scat,], axes=[self.ax_x, self.ax_y, self.ax_c],)
         self.scat.on_element_click(self.goto_db)
         self.scat.on_element_click(self.show_data)
+        # thumbnails are loaded one at a time, off the kernel's main thread
+        self._loader = ThreadPoolExecutor(max_workers=1)
+        self._hovered = None
+        self._hover_future = None
+        self._clicked = None
         if mouseover:
             self.scat.on_hover(self.show_thumb)
             self.scat.tooltip = widgets.HTML("")
-        self.x_selecta.observe(self.update_scatter)
-        self.y_selecta.observe(self.update_scatter)
-        self.c_selecta.observe(self.update_scatter)
+            self.scat.tooltip_style = {"opacity": 1.0}
+        self.x_selecta.observe(lambda change: self.update_axis("x"), names="value")
+        self.y_selecta.observe(lambda change: self.update_axis("y"), names="value")
+        self.c_selecta.observe(lambda change: self.update_axis("color"), names="value")
         self.connector = OMEConnect(host=host, port=4064)
         self.connector.gobtn.on_click(self.setup_graph)
         super().__init__([self.connector])
@@ -178,6 +208,9 @@ class ThumbScatterViz(widgets.VBox):
             if wait > 30:
                 self.children = [widgets.HTML("<a><h4>Connection time out</h4></a>")]
                 return
+        if self.pool is not None:
+            self.pool.close()
+        self.pool = SessionPool(self.conn, size=2)
 
         sbox_layout = widgets.Layout(min_width="120px")
         fig_layout = widgets.Layout(max_width="800px")
@@ -203,51 +236,241 @@ class ThumbScatterViz(widgets.VBox):
             ),
         ]
 
-    def update_scatter(self, elem):
-        col = self.x_selecta.value
-        if is_datetime(self.measures, col):
-            x_sc = DateScale()
-        else:
-            x_sc = LinearScale()
-        self.ax_x.scale = x_sc
-        self.scat.x = self.measures[col]
-        self.ax_x.label = col
-
-        col = self.y_selecta.value
-        if is_datetime(self.measures, col):
-            y_sc = DateScale()
-        else:
-            y_sc = LinearScale()
-        self.ax_y.scale = y_sc
-        self.scat.y = self.measures[col]
-        self.ax_y.label = col
-
-        col = self.c_selecta.value
-        if is_datetime(self.measures, col):
-            c_sc = DateColorScale()
-        else:
-            c_sc = ColorScale()
-        self.ax_c.scale = c_sc
-        self.scat.color = self.measures[col]
-        self.ax_c.label = col
-        self.scat.scales = {
-            "x": x_sc,
-            "y": y_sc,
-            "color": c_sc,
-        }
+    def close(self):
+        """Closes the widget, after the thumbnail load in progress,
+        and its server resources, see `release_connections`
+        """
+        # also called on garbage collection, possibly more than once
+        loader = self.__dict__.pop("_loader", None)
+        if loader is not None:
+            loader.shutdown(wait=True, cancel_futures=True)
+            self.release_connections()
+        super().close()
+
+    def release_connections(self):
+        """Closes the pooled connections but the initial one"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def update_scatter(self, elem=None):
+        """Updates all the plot axes to the selected columns"""
+        with self.scat.hold_sync():
+            for axis in ("x", "y", "color"):
+                self.update_axis(axis)
+
+    def update_axis(self, axis):
+        """Updates one of the "x", "y" or "color" axes to its selected column.
+
+        Only this column is sent to the plot, and the axis scale is
+        kept if the column type (dates or numbers) did not change.
+        """
+        selecta, ax = {
+            "x": (self.x_selecta, self.ax_x),
+            "y": (self.y_selecta, self.ax_y),
+            "color": (self.c_selecta, self.ax_c),
+        }[axis]
+        col = selecta.value
+        scale = self.scat.scales[axis]
+        is_date = isinstance(scale, (DateScale, DateColorScale))
+        with self.scat.hold_sync():
+            new_scale = is_date != is_datetime(self.measures, col)
+            if new_scale:
+                scale = self._new_scale(axis, col)
+                self.scat.scales = dict(self.scat.scales, **{axis: scale})
+                ax.scale = scale
+            else:
+                # the previous column range is meaningless for the new one
+                with scale.hold_sync():
+                    scale.min = None
+                    scale.max = None
+            ax.label = col
+            setattr(self.scat, axis, self.shown_array(col))
+            if new_scale and axis != "color" and self.lod:
+                # the new scale has no range, the rows of the whole table
+                self.refresh_points()
+
+    def _new_scale(self, axis, col):
+        if axis == "color":
+            if is_datetime(self.measures, col):
+                return DateColorScale(scheme="viridis")
+            return ColorScale()
+        scale = DateScale() if is_datetime(self.measures, col) else LinearScale()
+        self._watch_view(scale)
+        return scale
+
+    def column_array(self, col):
+        """Returns the values of column `col` as a compact array, dates as
+        datetime64[ms] (in UTC if they have a timezone), durations as float
+        seconds, integers as int32 when they fit, else as float64, and other
+        numbers as float32.
+
+        Arrays are cached, so switching back to a column costs no conversion.
+        """
+        arr = self._arrays.get(col)
+        if arr is None:
+            values = self.measures[col]
+            if is_datetime(self.measures, col):
+                arr = values.to_numpy(dtype="datetime64[ms]")
+            elif is_timedelta(self.measures, col):
+                arr = values.dt.total_seconds().to_numpy(dtype=np.float64)
+            else:
+                arr = values.to_numpy()
+                int32 = np.iinfo(np.int32)
+                if arr.dtype.kind not in "iub":
+                    arr = arr.astype(np.float32)
+                elif arr.size and int32.min <= arr.min() and arr.max() <= int32.max:
+                    arr = arr.astype(np.int32)
+                else:
+                    # float32 can't tell apart integers above 2**24
+                    arr = arr.astype(np.float64)
+            self._arrays[col] = arr
+        return arr
+
+    def shown_array(self, col):
+        """Returns the values of column `col` for the shown rows"""
+        arr = self.column_array(col)
+        if self.rows.size == arr.size:
+            return arr
+        return arr[self.rows]
+
+    @property
+    def lod(self):
+        """True if the table is too large for all its points to be shown"""
+        return len(self.measures) > self.max_points
+
+    def view_rows(self, x_sc, y_sc):
+        """Returns the positions of the rows to show given the x and y
+        scales ranges: all the rows in view if there are less than
+        `max_points`, else the `max_points` of highest priority among them
+        """
+        if not self.lod:
+            return np.arange(len(self.measures))
+
+        mask = np.ones(len(self.measures), dtype=bool)
+        for scale, col in ((x_sc, self.x_selecta.value), (y_sc, self.y_selecta.value)):
+            if scale.min is None and scale.max is None:
+                continue
+            values = self.column_array(col)
+            if scale.min is not None:
+                mask &= values >= _scale_bound(scale.min, values.dtype)
+            if scale.max is not None:
+                mask &= values <= _scale_bound(scale.max, values.dtype)
+        rows = np.flatnonzero(mask)
+        if rows.size > self.max_points:
+            keep = np.argpartition(self._priority[rows], self.max_points)
+            rows = np.sort(rows[keep[: self.max_points]])
+        return rows
+
+    def refresh_points(self):
+        """Updates the points shown to the current view"""
+        rows = self.view_rows(self.scat.scales["x"], self.scat.scales["y"])
+        if np.array_equal(rows, self.rows):
+            return
+        self.rows = rows
+        with self.scat.hold_sync():
+            self.scat.selected = None
+            self.scat.x = self.shown_array(self.x_selecta.value)
+            self.scat.y = self.shown_array(self.y_selecta.value)
+            self.scat.color = self.shown_array(self.c_selecta.value)
+            self.scat.names = self.measures.index[rows]
+
+    def _watch_view(self, scale):
+        if self.lod:
+            scale.observe(self._on_view_change, names=["min", "max"])
+
+    def _on_view_change(self, change):
+        # zooming changes min and max in a row, only refresh once
+        if self._view_timer is not None:
+            self._view_timer.cancel()
+            self._view_timer = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # outside of the kernel's event loop, e.g. in a script
+            self.refresh_points()
+            return
+        # on the kernel's event loop, as the other widget callbacks, so
+        # that the plot is never updated from two threads at once
+        self._view_timer = loop.call_later(0.2, self.refresh_points)
+
+    def selected_names(self):
+        """Returns the index of the selected points"""
+        selected = self.scat.selected
+        if selected is None or not len(selected):
+            return self.measures.index[:0]
+        return self.measures.index[self.rows[np.asarray(selected)]]
 
     def get_thumb(self, idx):
         raise NotImplementedError
 
+    def thumb_key(self, idx):
+        """Returns the key of the thumbnail of point `idx` in the thumbnail cache"""
+        raise NotImplementedError
+
+    @property
+    def server(self):
+        return (self.conn.host, self.conn.port)
+
+    @contextmanager
+    def session(self):
+        """Borrows a pooled connection recording its calls in `self.stats`"""
+        with self.pool.session() as conn:
+            yield instrument(conn, self.stats)
+
     def show_thumb(self, cbk, target):
+        """Shows the thumbnail of the hovered point in the tooltip.
+
+        If it is not in the cache, a placeholder is shown immediately
+        and the thumbnail is loaded in the background. Pending loads for
+        points the mouse already left are cancelled.
+        """
         name = target["data"]["name"]
-        self.scat.tooltip = widgets.HTML("")
-        self.scat.tooltip = widgets.HTML(self.get_thumb(name))
-        self.scat.tooltip.style = {"opacity": 1.0}
+        self._hovered = name
+        tooltip = self.scat.tooltip
+        cached = self.thumbs.get(self.thumb_key(name))
+        if cached is not None:
+            tooltip.value = cached
+            return
+        tooltip.value = LOADING
+        if self._hover_future is not None:
+            self._hover_future.cancel()
+        self._hover_future = self._loader.submit(self._load_hovered, name)
 
-    def goto_db(self, cbk, target):
+    def _load_hovered(self, name):
+        if name != self._hovered:
+            return
+        html_ = self._safe_thumb(name)
+        if name == self._hovered:
+            self.scat.tooltip.value = html_
+
+    def _safe_thumb(self, name):
+        try:
+            return self.get_thumb(name)
+        except Exception as err:
+            return f"<p>Thumbnail not available: {err}</p>"
+
+    def goto_url(self, name):
+        """Returns the url of point `name` in the omero web client"""
         raise NotImplementedError
 
+    def goto_db(self, cbk, target):
+        """Shows a link to the clicked point in the database, with its
+        thumbnail loaded in the background
+        """
+        name = target["data"]["name"]
+        self._clicked = name
+        url = self.goto_url(name)
+        link = '<p><hr></p><a href={} target="_blank">{}</a>'
+        self.goto.value = link.format(url, LOADING)
+
+        def load():
+            html_ = self._safe_thumb(name)
+            if name == self._clicked:
+                self.goto.value = link.format(url, html_)
+
+        self._loader.submit(load)
+
     def show_data(self, cbk, target):
         self.sheet.clear_output()
         name = target["data"]["name"]
@@ -276,6 +499,9 @@ class ROIScatterViz(ThumbScatterViz):
         mouseover=False,
         port=4090,
         host="localhost",
+        thumb_cache=None,
+        thumb_render=None,
+        max_points=50_000,
     ):
         """
         Parameters
@@ -286,40 +512,143 @@ class ROIScatterViz(ThumbScatterViz):
            those will be used as the x, y and color values for the initial plot
         port : int, default 4090, the port to connect to the DB
         mouseover : bool, default False
-            if True, will display a thumbnail as mouse over tooltip - might be lagging
+            if True, will display a thumbnail as mouse over tooltip,
+            loaded in the background
+        thumb_cache : `omero_utils.cache.ThumbCache`, optional
+            where the thumbnails are kept, see `ThumbScatterViz`
+        thumb_render : dict, optional
+            keyword arguments passed to `roi_utils.html_thumb` to render
+            the thumbnails, e.g. {"fmt": "webp", "quality": 70}
+        max_points : int, default 50_000
+            at most this number of points are shown, see `ThumbScatterViz`
 
         """
         self.image_id = image_id
+        self.thumb_render = dict(thumb_render or {})
+        self._prefetcher = None
+        self._prefetch_stop = threading.Event()
         self.image = None
         self.base_url = None
         super().__init__(
-            measures, x=x, y=y, c=c, port=port, mouseover=mouseover, host=host
+            measures,
+            x=x,
+            y=y,
+            c=c,
+            port=port,
+            mouseover=mouseover,
+            host=host,
+            thumb_cache=thumb_cache,
+            max_points=max_points,
         )
 
     def setup_graph(self, btn):
 
+        # the prefetch reads from the pool that is about to be replaced
+        self.stop_prefetch()
         super().setup_graph(btn)
-        self.image = self.conn.getObject("Image", self.image_id)
+        if self.pool is None:
+            return
+        gateway = instrument(self.conn, self.stats)
+        self.image = gateway.getObject("Image", self.image_id)
         self.base_url = f"""https://{self.conn.host}:{self.port}/webclient/img_detail/{self.image.id}/"""
-        if not self.conn.isConnected():
-            self.conn.connect()
-        roi_service = self.conn.getRoiService()
+        roi_service = gateway.getRoiService()
         self.rois = roi_service.findByImage(
             self.image.getId(), None, self.conn.SERVICE_OPTS
         ).rois
+        if self.mouseover:
+            self.prefetch_thumbs()
+
+    def prefetch_thumbs(self, chunk_size=256):
+        """Fills the thumbnails cache in a background thread, reading
+        the thumbnails of `chunk_size` ROIs at a time.
+
+        The prefetch stops once it has added as many bytes as the in memory
+        budget of the cache, since further thumbnails would evict the first
+        ones, or when `stop_prefetch` is called. A pooled connection is
+        only borrowed while a chunk is read.
+        """
+        self.stop_prefetch()
+        stop = self._prefetch_stop = threading.Event()
+        budget = getattr(self.thumbs, "max_bytes", float("inf"))
+
+        def fill():
+            added = count = 0
+            missing = (
+                idx for idx in range(len(self.rois))
+                if self.thumb_key(idx) not in self.thumbs
+            )
+            while not stop.is_set() and added < budget:
+                if count:
+                    # no more than the thumbnails fitting in the budget left
+                    size = min(chunk_size, int(-(-(budget - added) * count // added)))
+                else:
+                    # a first small chunk to estimate the thumbnails size
+                    size = min(chunk_size, 16)
+                todo = {idx: self.rois[idx] for idx in islice(missing, size)}
+                if not todo:
+                    return
+                with self.session() as conn:
+                    thumbs = get_roi_thumbs(
+                        conn, self.image, todo, draw_roi=True, size=self.thumb_size
+                    )
+                for idx, thumb in thumbs.items():
+                    html_ = self.render_thumb(thumb)
+                    self.thumbs.setdefault(self.thumb_key(idx), html_)
+                    added += len(html_)
+                    count += 1
+
+        self._prefetcher = threading.Thread(target=fill, daemon=True)
+        self._prefetcher.start()
+
+    def stop_prefetch(self):
+        """Stops the thumbnails prefetch, waiting for the chunk being read"""
+        self._prefetch_stop.set()
+        if self._prefetcher is not None:
+            self._prefetcher.join()
+            self._prefetcher = None
+
+    def release_connections(self):
+        self.stop_prefetch()
+        super().release_connections()
+
+    def thumb_key(self, idx):
+        # as a string, the render parameters may contain lists
+        render = repr(sorted(self.thumb_render.items()))
+        return (
+            self.server,
+            "roi",
+            self.image_id,
+            self.rois[idx].getId().val,
+            True,
+            render,
+        )
+
+    @property
+    def thumb_size(self):
+        """The display size of the thumbnails, pyramidal images are
+        read at the coarsest resolution level larger than it
+        """
+        return self.thumb_render.get("size", 200)
+
+    def render_thumb(self, thumb):
+        return html_thumb(thumb, **self.thumb_render)
 
     def get_thumb(self, idx):
 
-        th = self.thumbs.get(idx)
+        key = self.thumb_key(idx)
+        th = self.thumbs.get(key)
         if th is None:
             roi = self.rois[idx]
-            th = html_thumb(get_roi_thumb(self.conn, self.image, roi, draw_roi=True))
-            self.thumbs[idx] = th
+            with self.session() as conn:
+                th = self.render_thumb(
+                    get_roi_thumb(
+                        conn, self.image, roi, draw_roi=True, size=self.thumb_size
+                    )
+                )
+            self.thumbs[key] = th
         return th
 
-    def goto_db(self, cbk, target):
-        name = target["data"]["name"]
-        html_ = self.get_thumb(name)
+    def goto_url(self, name):
         try:
             pixel_size = self.image.getPrimaryPixels().getPhysicalSizeX().getValue()
         except AttributeError:
@@ -328,8 +657,7 @@ class ROIScatterViz(ThumbScatterViz):
         xc, yc = int(current.X / pixel_size), int(current.Y / pixel_size)
         coords = f"?x={xc}&y={yc}&zm=400"
         colors = "&c=1|0:255$FF0000,2|0:255$00FF00,3|0:255$0000FF,-4|0:255$FF0000&m=c"
-        url = self.base_url + coords + colors
-        self.goto.value = f'<p><hr></p><a href={url} target="_blank">{html_}</a>'
+        return self.base_url + coords + colors
 
 
 class ImageScatterViz(ThumbScatterViz):
@@ -342,6 +670,11 @@ class ImageScatterViz(ThumbScatterViz):
         port=4090,
         mouseover=False,
         host="localhost",
+        thumb_cache=None,
+        thumb_size=128,
+        batch_size=64,
+        prefetch_batches=4,
+        max_points=50_000,
     ):
         """Scatterplot with dynamic link to images in an omero database
 
@@ -355,42 +688,180 @@ class ImageScatterViz(ThumbScatterViz):
 
         mouseover: bool, default False
             if True, displays a thumbnail of the image when the mouse is over a point
+        thumb_cache : `omero_utils.cache.ThumbCache`, optional
+            where the thumbnails are kept, see `ThumbScatterViz`
+        thumb_size : int, default 128
+            size of the longest side of the thumbnails
+        batch_size : int, default 64
+            number of thumbnails retrieved at once: when a thumbnail is missing,
+            the ones of the selected points, or of the points in the plot view
+            closest to it, are retrieved with it
+        prefetch_batches : int, default 4
+            at most this number of batches of thumbnails of the selected
+            points are retrieved ahead when the selection changes
+        max_points : int, default 50_000
+            at most this number of points are shown, see `ThumbScatterViz`
         """
+        self.thumb_size = thumb_size
+        self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
+        self._stores = {}
+        self._select_futures = []
         super().__init__(
-            measures, x=x, y=y, c=c, port=port, mouseover=mouseover, host=host
+            measures,
+            x=x,
+            y=y,
+            c=c,
+            port=port,
+            mouseover=mouseover,
+            host=host,
+            thumb_cache=thumb_cache,
+            max_points=max_points,
         )
-        self.thumbs = {}
+        self.scat.observe(self._on_select, names=["selected"])
+
+    def thumb_key(self, idx):
+        return (self.server, "image", idx, self.thumb_size)
+
+    def setup_graph(self, btn):
+        # the stores belong to the connections of the pool being replaced
+        self._cancel_prefetch()
+        self._loader.submit(self.close_stores).result()
+        super().setup_graph(btn)
+
+    def close_stores(self):
+        """Closes the thumbnail stores of the pooled connections"""
+        stores, self._stores = self._stores, {}
+        for store in stores.values():
+            try:
+                store.close()
+            except Exception:
+                # the connection is already closed
+                pass
+
+    def release_connections(self):
+        self.close_stores()
+        super().release_connections()
 
     def get_thumb(self, idx):
 
-        thumb = self.thumbs.get(idx)
+        key = self.thumb_key(idx)
+        thumb = self.thumbs.get(key)
+        if thumb is None:
+            self.fetch_thumbs([idx] + self.visible_neighbours(idx, self.batch_size - 1))
+            # not cached if missing, the image might be reachable later
+            thumb = self.thumbs.get(key, "<p>Image not reachable</p>")
+        return thumb
+
+    def fetch_thumbs(self, ids):
+        """Retrieves the thumbnails of the images `ids` missing from
+        the cache with a single call to the thumbnail store
+        """
+        ids = [idx for idx in ids if self.thumb_key(idx) not in self.thumbs]
+        if not ids:
+            return
         tag_start = (
             '<img style="width: 200px; max-height: 200px" src="data:image/jpg;base64,'
         )
-        if thumb is None:
-            self.conn.connect()
-            self.conn.SERVICE_OPTS.setOmeroGroup("-1")
-            tb = self.conn.createThumbnailStore()
+        with self.session() as conn:
+            conn.SERVICE_OPTS.setOmeroGroup("-1")
+            store = self._stores.get(id(uninstrument(conn)))
+            if store is None:
+                store = conn.createThumbnailStore()
+                self._stores[id(uninstrument(conn))] = store
             try:
-                tb.setPixelsId(idx, self.conn.SERVICE_OPTS)
-                th = tb.getThumbnailDirect(rint(128), rint(128), self.conn.SERVICE_OPTS)
-                th = base64.b64encode(th).decode("utf-8")
-                thumb = f'{tag_start}{th}">'
+                thumbs = get_thumbnails(ids, conn, size=self.thumb_size, store=store)
             except omero.ResourceError:
-                thumb = "<p>Image not reachable</p>"
+                thumbs = {}
+            except Exception:
+                # the store is probably closed, a new one will be created
+                self._stores.pop(id(uninstrument(conn)), None)
+                raise
+        for idx, th in thumbs.items():
+            th = base64.b64encode(th).decode("utf-8")
+            self.thumbs[self.thumb_key(idx)] = f'{tag_start}{th}">'
+
+    def visible_neighbours(self, idx, n):
+        """Returns up to `n` points without a cached thumbnail, among the
+        selected points if any, else among the points in the plot view,
+        the closest to `idx` first
+        """
+        selected = self.selected_names()
+        if len(selected):
+            data = self.measures.loc[selected]
+        else:
+            data = self.measures.iloc[self.rows]
+            for scale, col in (
+                (self.scat.scales["x"], self.x_selecta.value),
+                (self.scat.scales["y"], self.y_selecta.value),
+            ):
+                if scale.min is not None:
+                    data = data[data[col] >= scale.min]
+                if scale.max is not None:
+                    data = data[data[col] <= scale.max]
+        cols = [self.x_selecta.value, self.y_selecta.value]
+        coords = _as_float(data[cols])
+        spread = coords.std(axis=0)
+        spread[~(spread > 0)] = 1.0
+        origin = _as_float(self.measures.loc[[idx], cols])[0]
+        order = np.argsort((((coords - origin) / spread) ** 2).sum(axis=1))
+        neighbours = []
+        for name in data.index[order]:
+            if len(neighbours) >= n:
+                break
+            if name != idx and self.thumb_key(name) not in self.thumbs:
+                neighbours.append(name)
+        return neighbours
+
+    def _cancel_prefetch(self):
+        for future in self._select_futures:
+            future.cancel()
+        self._select_futures = []
+
+    def _on_select(self, change):
+        # the prefetch of the previous selection is not needed anymore
+        self._cancel_prefetch()
+        names = list(self.selected_names())
+        if not names or self.pool is None:
+            return
+        names = names[: self.batch_size * self.prefetch_batches]
+        self._select_futures = [
+            self._loader.submit(self.fetch_thumbs, chunk)
+            for chunk in chunked(names, self.batch_size)
+        ]
 
-            self.thumbs[idx] = thumb
+    def goto_url(self, name):
+        return f"""https://{self.conn.host}:{self.port}/webclient/img_detail/{name}/"""
 
-        return thumb
 
-    def goto_db(self, cbk, target):
-        name = target["data"]["name"]
-        html_ = self.get_thumb(name)
+def is_datetime(data, col):
 
-        url = f"""https://{self.conn.host}:{self.port}/webclient/img_detail/{name}/"""
-        self.goto.value = f'<p><hr></p><a href={url} target="_blank">{html_}</a>'
+    return pd.api.types.is_datetime64_any_dtype(data[col])
 
 
-def is_datetime(data, col):
+def is_timedelta(data, col):
+
+    return pd.api.types.is_timedelta64_dtype(data[col])
+
 
-    return hasattr(data[col], "dt")
+def _scale_bound(value, dtype):
+    """Converts a scale bound to a value comparable with an array of `dtype`"""
+    if dtype.kind == "M":
+        return pd.Timestamp(value).to_datetime64().astype(dtype)
+    return float(value)
+
+
+def _as_float(data):
+    """Returns the columns of `data` as a 2D float array,
+    with datetimes converted to timestamps and durations to seconds
+    """
+    columns = []
+    for col in data.columns:
+        if is_datetime(data, col):
+            values = data[col].to_numpy(dtype="datetime64[ns]").astype("int64")
+        elif is_timedelta(data, col):
+            values = data[col].dt.total_seconds()
+        else:
+            values = data[col]
+        columns.append(np.asarray(values, dtype=float))
+    return np.column_stack(columns)